@@ -9,25 +9,159 @@ import getopt
 import sys
 import re
 import time
+import threading
+import concurrent.futures
+import itertools
+import queue
 from tkinter import *
 from tkinter.ttk import Notebook
 from matplotlib.figure import Figure
 import matplotlib.dates as mdates
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from matplotlib.patches import Rectangle
+from matplotlib.collections import PolyCollection
 from matplotlib import cm
 from matplotlib import colors
 import random
+import numpy as np
+import csv
+import gzip
+import io
+import os
+import hashlib
+import zlib
+import tempfile
+import functools
+import email.utils
+# faster JSON parsing of the statistics, when available
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 G_DB_NAME = "wf_mkt_hist.db"
 G_DB_NAME_RO = "file:" + G_DB_NAME + "?mode=ro"
+# tuning of the read-only connections
+G_DB_RO_MMAP_SIZE = 256*1024*1024
+G_DB_RO_CACHE_SIZE = -64*1024 # negative is in KiB
+G_DB_RO_CACHED_STATEMENTS = 256
 G_DB_ITEMS_NAME = "items"
 G_DB_ITEMS_HIST = "hist"
 G_DB_TAGS_NAME = "tags"
 G_DB_ITEMS_TAGS = "items_attrs"
+G_DB_SUMMARY = "summary"
+G_DB_ITEMS_FTS = "items_fts"
+G_DB_FETCH_LOG = "fetch_log"
+G_DB_UPDATE_CKPT = "update_ckpt"
 G_WFM_USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36'
+# JSON backend of parse_hist_stats: 'orjson' (if installed), 'json' which
+# only decodes the closed 90 days statistics or 'json-full'
+G_JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+G_JSON_DECODER = json.JSONDecoder()
+G_RE_STATS_CLOSED = re.compile(r'"statistics_closed"\s*:\s*\{')
+G_RE_STATS_90DAYS = re.compile(r'"90days"\s*:\s*')
+# subtypes of the statistics kept, others are reported
+G_HIST_SUBTYPES = frozenset([None, 'intact', 'basic', 'small', 'revealed', 'blueprint'])
+G_RE_AYATAN = re.compile(r'^ayatan.*sculpture$', re.IGNORECASE)
 G_SLEEP_THROTTLE = 0.34 # for now it's 3 requests per second
+# adaptive throttling: starting from the rate set by G_SLEEP_THROTTLE
+# it's increased by G_ADAPTIVE_STEP req/s for each healthy response and
+# multiplied by G_ADAPTIVE_DECREASE on 429/5xx or slow responses
+G_ADAPTIVE = False
+G_ADAPTIVE_MIN_RATE = 0.2
+G_ADAPTIVE_MAX_RATE = 20.0
+G_ADAPTIVE_STEP = 0.05
+G_ADAPTIVE_DECREASE = 0.5
+G_ADAPTIVE_SLOW_DECREASE = 0.9
+# responses are slow when the average latency exceeds
+# this many times the lowest average seen
+G_ADAPTIVE_SLOW_FACTOR = 2.0
+# the requests in flight when the rate is decreased
+# would decrease it again, hence the hold time
+G_ADAPTIVE_HOLD = 1.0
+G_FETCH_WORKERS = 1
+G_WFM_API_URL = "https://api.warframe.market"
+G_DB_BATCH_SIZE = 50
+# retries of a failing item within the same update, waiting
+# G_FETCH_BACKOFF*2^n s (plus some jitter) before the n-th one
+G_FETCH_RETRIES = 3
+G_FETCH_BACKOFF = 1.0
+# on-disk cache of the raw API responses, disabled
+# unless a directory is specified
+G_WFM_CACHE = None
+G_CACHE_DIR = "wf_mkt_cache"
+G_CACHE_MAX_SIZE = 256*1024*1024
+# time to live in seconds of the cached responses, the first
+# matching endpoint wins; anything else is never fresh
+G_CACHE_TTLS = [
+    (re.compile(r'^/v2/items$'), 24*3600),
+    (re.compile(r'^/v1/items/[^/]+/statistics$'), 3600),
+    (re.compile(r'^/v2/items/[^/]+$'), 7*24*3600),
+]
+# day windows precomputed in the summary table
+G_SUMMARY_WINDOWS = [1, 5, 7, 30, 90]
+# migration step deferred until all the migrations are committed
+G_DB_VACUUM = "VACUUM"
+# schema migrations, each entry migrates the DB from
+# the version matching its index to the next one; steps
+# are either SQL statements or functions taking the DB
+G_DB_MIGRATIONS = [
+    [
+        # remove any duplicate before creating the unique indices
+        "DELETE FROM " + G_DB_ITEMS_HIST + " WHERE rowid NOT IN (SELECT MIN(rowid) FROM " + G_DB_ITEMS_HIST + " GROUP BY id, ts)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS u_hist ON " + G_DB_ITEMS_HIST + "(id, ts)",
+        "DELETE FROM " + G_DB_ITEMS_TAGS + " WHERE rowid NOT IN (SELECT MIN(rowid) FROM " + G_DB_ITEMS_TAGS + " GROUP BY item_id, tag_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS u_items_attrs ON " + G_DB_ITEMS_TAGS + "(item_id, tag_id)",
+    ],
+    [
+        # i1 on hist(id) is a prefix of u_hist, while the summary
+        # needs a covering index for the interval on ts
+        "DROP INDEX IF EXISTS i1",
+        "CREATE INDEX IF NOT EXISTS i_hist_ts ON " + G_DB_ITEMS_HIST + "(ts, id, volume, avg)",
+        "ANALYZE",
+    ],
+    [
+        # rollup of do_summary per item and window of days, all
+        # rows are relative to the same reference date
+        "CREATE TABLE IF NOT EXISTS " + G_DB_SUMMARY + " (id integer, days integer, ref_date text, price real, volume real, change real, PRIMARY KEY(id, days))",
+    ],
+    [
+        lambda db: db_setup_names_fts(db),
+    ],
+    [
+        # timestamps as epoch seconds rather than ISO text
+        "UPDATE " + G_DB_ITEMS_HIST + " SET ts=CAST(STRFTIME('%s', ts) AS INTEGER) WHERE typeof(ts)='text'",
+        "ANALYZE",
+        # run once the new version is committed
+        G_DB_VACUUM,
+    ],
+    [
+        # last successful fetch of each item and the HTTP
+        # validators of its statistics
+        "CREATE TABLE IF NOT EXISTS " + G_DB_FETCH_LOG + " (item_id integer PRIMARY KEY, ts integer, etag text, last_modified text)",
+    ],
+    [
+        # progress of the last update, status is one of
+        # 'pending', 'failed' or 'done'
+        "CREATE TABLE IF NOT EXISTS " + G_DB_UPDATE_CKPT + " (name text PRIMARY KEY, slug text, status text, attempts integer, last_error text, ts integer)",
+    ],
+]
+# first schema version storing hist.ts as epoch seconds
+G_DB_INT_TS_VERSION = 5
 G_N_DAYS_HIST = 365
+G_EXPORT_FETCH_SIZE = 4096
+# binary export: magic, header length, JSON header then
+# the column arrays, each aligned to G_EXPORT_ALIGN bytes
+G_EXPORT_MAGIC = b'WFMHIST1'
+G_EXPORT_ALIGN = 64
+# hist values stored as integers
+G_HIST_INT_VALUES = ['volume', 'min', 'max', 'open', 'close']
+G_SEARCH_DEBOUNCE_MS = 250
+G_SEARCH_POLL_MS = 25
+# the historical view keeps at most a point every G_HIST_PX_PER_POINT
+# pixels on its lines and a bar every G_HIST_PX_PER_BAR pixels
+G_HIST_PX_PER_POINT = 2
+G_HIST_PX_PER_BAR = 4
+G_HIST_TOOLBAR_H = 32
 
 def uniform_str(s):
     spl = s.split()
@@ -49,37 +183,135 @@ def update_db_names(db):
     for k, v in nm.items():
         q = "update " + G_DB_ITEMS_NAME + " set name=? where ROWID=?"
         cur.execute(q, (uniform_str(k), v))
+    db_sync_names_fts(db)
     db.commit()
     return None
 
+def db_has_table(db, tb_nm):
+    cur = db.cursor()
+    ri = cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (tb_nm,))
+    return ri.fetchone() is not None
+
+# trigram index on the item names, it's used to resolve the LIKE
+# searches to item ids; this is optional as it requires FTS5
+def db_setup_names_fts(db):
+    cur = db.cursor()
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + G_DB_ITEMS_FTS + " USING fts5(name, tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        print("Trigram index on names not available, carrying on (", e, ")")
+        return None
+    db_sync_names_fts(db)
+    return None
+
+# the index shares the rowid with the items, drop the removed
+# names (e.g. see compact_names.sql), add the new ones and fix
+# any changed one; left to the caller to commit
+def db_sync_names_fts(db):
+    if not db_has_table(db, G_DB_ITEMS_FTS):
+        return None
+    cur = db.cursor()
+    cur.execute("DELETE FROM " + G_DB_ITEMS_FTS + " WHERE rowid NOT IN (SELECT rowid FROM " + G_DB_ITEMS_NAME + ")")
+    cur.execute("DELETE FROM " + G_DB_ITEMS_FTS + " WHERE rowid IN (SELECT f.rowid FROM " + G_DB_ITEMS_FTS + " f JOIN " + G_DB_ITEMS_NAME + " i ON (i.rowid=f.rowid) WHERE f.name<>i.name)")
+    cur.execute("INSERT INTO " + G_DB_ITEMS_FTS + "(rowid, name) SELECT i.rowid, i.name FROM " + G_DB_ITEMS_NAME + " i WHERE NOT EXISTS (SELECT 1 FROM " + G_DB_ITEMS_FTS + " f WHERE f.rowid=i.rowid)")
+    return None
+
 def db_setup(db):
     cur = db.cursor()
     cur.execute("CREATE TABLE IF NOT EXISTS " + G_DB_ITEMS_NAME + " (name text)")
     cur.execute("CREATE TABLE IF NOT EXISTS " + G_DB_ITEMS_HIST + " (id integer, ts timestamp, volume integer, min integer, max integer, open integer, close integer, avg real, w_avg real, median real, m_avg real)")
-    cur.execute("CREATE INDEX IF NOT EXISTS i1 ON " + G_DB_ITEMS_HIST + "(id)")
     cur.execute("CREATE TABLE IF NOT EXISTS " + G_DB_TAGS_NAME + " (name text)")
     cur.execute("CREATE TABLE IF NOT EXISTS " + G_DB_ITEMS_TAGS + " (item_id integer, tag_id integer)")
     db.commit()
     return None
 
-def db_fetch_names(db, tb_nm, nm):
+G_DB_RO_LOCAL = threading.local()
+
+# returns the read-only connection of the calling thread, opened
+# once per process; no schema setup is performed on these
+def db_ro():
+    db = getattr(G_DB_RO_LOCAL, 'db', None)
+    if db is None:
+        db = sqlite3.connect(G_DB_NAME_RO, uri=True, cached_statements=G_DB_RO_CACHED_STATEMENTS)
+        cur = db.cursor()
+        cur.execute("PRAGMA mmap_size=" + str(G_DB_RO_MMAP_SIZE))
+        cur.execute("PRAGMA cache_size=" + str(G_DB_RO_CACHE_SIZE))
+        cur.execute("PRAGMA temp_store=MEMORY")
+        G_DB_RO_LOCAL.db = db
+    return db
+
+def db_version(db):
     cur = db.cursor()
-    for i in nm:
-        q = "INSERT INTO " + tb_nm + "(name) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM " + tb_nm + " WHERE name=?)";
-        cur.execute(q, (i, i))
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+def db_vacuum(db):
+    # can't be run within a transaction
     db.commit()
-    rv = {}
-    ri = cur.execute("SELECT MAX(rowid) as id, name FROM " + tb_nm + " WHERE 1=1 GROUP BY name")
-    for i in ri:
-        rv[i[1]] = i[0]
-    return rv
+    db.execute("VACUUM")
+    return None
+
+# brings the schema to the latest version, has to be invoked on
+# read/write connections only; each migration is committed along
+# with its version, VACUUM can't be part of it and runs at the end
+def db_migrate(db):
+    cur = db.cursor()
+    version = db_version(db)
+    vacuum = False
+    for i in range(version, len(G_DB_MIGRATIONS)):
+        for q in G_DB_MIGRATIONS[i]:
+            if q == G_DB_VACUUM:
+                vacuum = True
+            elif callable(q):
+                q(db)
+            else:
+                cur.execute(q)
+        cur.execute("PRAGMA user_version=" + str(i+1))
+        db.commit()
+    if vacuum:
+        db_vacuum(db)
+    return None
 
-def db_fetch_ts(db, nm_id):
+# hist.ts is either ISO text or epoch seconds (see
+# G_DB_INT_TS_VERSION), read paths have to support both
+def db_int_ts(db):
+    return db_version(db) >= G_DB_INT_TS_VERSION
+
+def db_ts_to_datetime(ts):
+    if isinstance(ts, int):
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(ts)
+
+def db_ts_to_epoch(ts):
+    if isinstance(ts, int):
+        return ts
+    return parse_iso_epoch(ts)
+
+# SQL condition for the timestamp col being within the last
+# :interval, i.e. from midnight (UTC) of that day onwards
+def build_ts_since(col, int_ts):
+    if int_ts:
+        return col + " >= CAST(STRFTIME('%s', DATE('now', :interval)) AS INTEGER)"
+    return col + " > DATE('now', :interval)"
+
+# adds the missing names and returns the ids of all of them,
+# within the transaction of the caller (i.e. the batch)
+def db_fetch_names(db, tb_nm, nm):
+    cur = db.cursor()
+    q = "INSERT INTO " + tb_nm + "(name) SELECT ? WHERE NOT EXISTS (SELECT 1 FROM " + tb_nm + " WHERE name=?)";
+    cur.executemany(q, [(i, i) for i in nm])
+    n_new = cur.rowcount
+    if tb_nm == G_DB_ITEMS_NAME and n_new > 0:
+        db_sync_names_fts(db)
+    return db_names_ids(db, tb_nm)
+
+# ids of all the names, read only (i.e.
+# for the connections of db_ro too)
+def db_names_ids(db, tb_nm):
     cur = db.cursor()
-    ri = cur.execute("SELECT ts FROM " + G_DB_ITEMS_HIST + " WHERE 1=1 AND id=? GROUP BY ts", (nm_id,))
     rv = {}
+    ri = cur.execute("SELECT MAX(rowid) as id, name FROM " + tb_nm + " WHERE 1=1 GROUP BY name")
     for i in ri:
-        rv[datetime.datetime.fromisoformat(i[0])] = 1
+        rv[i[1]] = i[0]
     return rv
 
 def db_fetch_names_tags(db):
@@ -92,63 +324,187 @@ def db_fetch_names_tags(db):
 
 def db_fetch_max_ts(db):
     cur = db.cursor()
-    ri = cur.execute("SELECT CAST(JULIANDAY('now') - JULIANDAY(MAX(ts)) as INT) FROM " + G_DB_ITEMS_HIST + " WHERE 1=1")
+    ri = cur.execute("SELECT CAST(JULIANDAY('now') - JULIANDAY(MAX(ts), 'unixepoch') as INT) FROM " + G_DB_ITEMS_HIST + " WHERE 1=1")
     for i in ri:
         return i[0]
     return sys.maxsize
 
+# freshness planner: an item has to be fetched unless its history
+# already has the last closed day or it has been fetched since the
+# last UTC midnight (i.e. it had no trades that day); returns the items
+# to fetch and, for those, the validators of their previous fetch
+def plan_hist_fetch(db, item_names):
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    last_day = int((today - datetime.timedelta(days=1)).timestamp())
+    cur = db.cursor()
+    ri = cur.execute("""
+SELECT  n.name, h.max_ts, f.ts, f.etag, f.last_modified
+FROM    """ + G_DB_ITEMS_NAME + """ n
+LEFT JOIN (
+    SELECT  id, MAX(ts) as max_ts
+    FROM    """ + G_DB_ITEMS_HIST + """
+    GROUP BY id
+) h
+ON      (n.rowid=h.id)
+LEFT JOIN """ + G_DB_FETCH_LOG + """ f
+ON      (n.rowid=f.item_id)""")
+    state = {}
+    for i in ri:
+        state[i[0]] = i[1:]
+    rv = {}
+    rv_validators = {}
+    for nm, q_nm in item_names.items():
+        st = state.get(nm)
+        if st is not None:
+            if (st[0] is not None and st[0] >= last_day) or (st[1] is not None and st[1] >= today.timestamp()):
+                continue
+            rv_validators[nm] = (st[2], st[3])
+        rv[nm] = q_nm
+    return rv, rv_validators
+
+# refreshes the summary rollup for the given item ids; if the
+# reference date has changed all the items get refreshed
+def db_refresh_summary(db, ids):
+    cur = db.cursor()
+    ri = cur.execute("SELECT COUNT(0), SUM(ref_date=DATE('now')) FROM " + G_DB_SUMMARY)
+    n_rows, n_cur = ri.fetchone()
+    full_refresh = (n_rows == 0) or (n_rows != n_cur)
+    if not full_refresh and not ids:
+        return None
+    query = """
+INSERT OR REPLACE INTO summary(id, days, ref_date, price, volume, change)
+SELECT  ts_x.id, :days, DATE('now'), ts_x.price, ts_x.volume, 100.0 + 100.0*((h_max.avg - h_min.avg)/h_min.avg)
+FROM    (
+    SELECT  h.id, min(h.ts) as min_ts, max(h.ts) as max_ts, avg(volume) as volume, avg(avg) as price
+    FROM    hist h
+    WHERE   1=1
+    AND     """ + build_ts_since("h.ts", True)
+    if not full_refresh:
+        query += """
+    AND     h.id IN (SELECT value FROM json_each(:ids))"""
+    query += """
+    GROUP BY h.id
+) ts_x
+JOIN    hist h_min
+ON      (ts_x.id=h_min.id AND h_min.ts=ts_x.min_ts)
+JOIN    hist h_max
+ON      (ts_x.id=h_max.id AND h_max.ts=ts_x.max_ts)
+"""
+    if full_refresh:
+        cur.execute("DELETE FROM " + G_DB_SUMMARY)
+    for d in G_SUMMARY_WINDOWS:
+        cur.execute(query, {'days': d, 'interval': "-" + str(d) + " days", 'ids': json.dumps(ids)})
+    db.commit()
+    return None
+
+# checks whether the summary rollup can be used
+# for a given window of days
+def db_summary_current(db, n_days):
+    if n_days not in G_SUMMARY_WINDOWS:
+        return False
+    if not db_has_table(db, G_DB_SUMMARY):
+        return False
+    cur = db.cursor()
+    ri = cur.execute("SELECT MIN(ref_date)=DATE('now') AND MAX(ref_date)=DATE('now') FROM " + G_DB_SUMMARY + " WHERE days=?", (n_days,))
+    return bool(ri.fetchone()[0])
+
+# starts a new update checkpoint with all the items pending
+def db_checkpoint_start(db, item_names):
+    cur = db.cursor()
+    cur.execute("DELETE FROM " + G_DB_UPDATE_CKPT)
+    cur.executemany("INSERT INTO " + G_DB_UPDATE_CKPT + "(name, slug, status, attempts) VALUES(?, ?, 'pending', 0)", item_names.items())
+    db.commit()
+
+# items of the last update not done yet
+def db_checkpoint_pending(db):
+    cur = db.cursor()
+    rv = {}
+    for r in cur.execute("SELECT name, slug FROM " + G_DB_UPDATE_CKPT + " WHERE status<>'done' ORDER BY rowid"):
+        rv[r[0]] = r[1]
+    return rv
+
+# records the outcome of an item, left to the
+# transaction of the batch being written
+def db_checkpoint_item(db, item_name, attempts, err=None):
+    cur = db.cursor()
+    cur.execute("UPDATE " + G_DB_UPDATE_CKPT + " SET status=?, attempts=attempts+?, last_error=?, ts=CAST(STRFTIME('%s', 'now') AS INTEGER) WHERE name=?", ('done' if err is None else 'failed', attempts, None if err is None else str(err), item_name))
+
 def db_insert_raw_data(db, all_data):
-    cur_max_ts_interval = db_fetch_max_ts(db)
-    if not cur_max_ts_interval:
-        cur_max_ts_interval = 0
     nm_id = db_fetch_names(db, G_DB_ITEMS_NAME, all_data.keys())
+    # push all the tags of the batch in one go
+    all_tags = {}
+    for v in all_data.values():
+        for r in v[1]:
+            all_tags[r] = 1
+    cur_tags = db_fetch_names(db, G_DB_TAGS_NAME, all_tags.keys())
     cur = db.cursor()
     rv_stats = {}
     for k, v in all_data.items():
-        rv_stats[k] = 0
-        # select all dates for given item
-        # and insert missing dates
-        all_ts = db_fetch_ts(db, nm_id[k])
-        for r in v[0]:
-            if r[0] in all_ts.keys():
-                continue
-            cur.execute("INSERT INTO " + G_DB_ITEMS_HIST + " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", (nm_id[k], r[0].isoformat(" "), r[1], r[2], r[3], r[4], r[5], r[6], r[7], r[8], r[9]))
-            rv_stats[k] = rv_stats[k]+1
-        # push all the tags - we're fetching more than
-        # required but it's ok for now
-        cur_tags = db_fetch_names(db, G_DB_TAGS_NAME, v[1])
-        # add the tags for a given item
-        for r in v[1]:
-            cur.execute("INSERT INTO " + G_DB_ITEMS_TAGS + "(item_id, tag_id) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM " + G_DB_ITEMS_TAGS + " WHERE item_id=? and tag_id=?)", (nm_id[k], cur_tags[r], nm_id[k], cur_tags[r]))
-    db.commit()
-    return rv_stats, cur_max_ts_interval
+        # dates already present are skipped by
+        # the unique index on (id, ts)
+        cur.executemany("INSERT OR IGNORE INTO " + G_DB_ITEMS_HIST + " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [(nm_id[k],) + r for r in v[0]])
+        rv_stats[k] = cur.rowcount
+    # add the tags for all the items, same as above
+    # for the unique index on (item_id, tag_id)
+    cur.executemany("INSERT OR IGNORE INTO " + G_DB_ITEMS_TAGS + "(item_id, tag_id) VALUES(?, ?)", [(nm_id[k], cur_tags[r]) for k, v in all_data.items() for r in v[1]])
+    # and finally log the fetch
+    cur.executemany("INSERT OR REPLACE INTO " + G_DB_FETCH_LOG + "(item_id, ts, etag, last_modified) VALUES(?, CAST(STRFTIME('%s', 'now') AS INTEGER), ?, ?)", [(nm_id[k], v[3][0], v[3][1]) for k, v in all_data.items()])
+    return rv_stats
+
+# the dates are the same for all the items of a given day, hence
+# worth caching; naive ones are UTC as for STRFTIME('%s', ...)
+@functools.lru_cache(maxsize=4096)
+def parse_iso_epoch(s):
+    dt = datetime.datetime.fromisoformat(s)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+# returns the 'statistics_closed' '90days' list only; the stdlib json
+# backend decodes just that array and falls back to parsing the whole
+# document if it can't be located unambiguously
+def load_hist_closed(data):
+    if G_JSON_BACKEND == 'orjson' and orjson is not None:
+        hist_data = orjson.loads(data)
+    elif G_JSON_BACKEND == 'json':
+        m = G_RE_STATS_CLOSED.search(data)
+        m_90 = G_RE_STATS_90DAYS.search(data, m.end()) if m is not None else None
+        # the '90days' key found has to belong to
+        # 'statistics_closed' rather than to the next object
+        if m_90 is not None and data.find('"statistics_live"', m.end(), m_90.start()) < 0:
+            try:
+                return G_JSON_DECODER.raw_decode(data, m_90.end())[0]
+            except ValueError:
+                pass
+        hist_data = json.loads(data)
+    else:
+        hist_data = json.loads(data)
+    if hist_data is None:
+        return []
+    return hist_data["payload"]["statistics_closed"]["90days"]
 
 def parse_hist_stats(data, item_name):
-    hist_data = json.loads(data)
     rv = []
-    subytpes_r = [None, 'intact', 'basic', 'small', 'revealed', 'blueprint']
     subtype_found = {}
-    if hist_data is not None:
-        for x in hist_data["payload"]["statistics_closed"]["90days"]:
-            # skip fully upgraded mods
-            if x.get('mod_rank', 0) != 0:
-                continue
-            # check if there's 'cyan_stars' and 'amber_stars' and if so
-            # ensure those are 2 and 1 and the name of the item is ayatan*sculpture
-            if re.match(r'^ayatan.*sculpture$', item_name, re.IGNORECASE):
-                if x.get('cyan_stars', 0) != 2 or x.get('amber_stars', 0) != 1:
-                    continue
-            # skip non 'intact' relics or fishes
-            # use the list for other types
-            if x.get('subtype', None) not in subytpes_r:
-                subtype_found[x.get('subtype', None)] = 0
-                continue
-            rv.append((datetime.datetime.fromisoformat(x['datetime']), int(x['volume']), int(x['min_price']), int(x['max_price']), int(x['open_price']), int(x['closed_price']), float(x['avg_price']), float(x['wa_price']), float(x['median']), float(x.get('moving_avg', 0.0))))
+    # check if there's 'cyan_stars' and 'amber_stars' and if so
+    # ensure those are 2 and 1 and the name of the item is ayatan*sculpture
+    is_ayatan = G_RE_AYATAN.match(item_name) is not None
+    for x in load_hist_closed(data):
+        # skip fully upgraded mods
+        if x.get('mod_rank', 0) != 0:
+            continue
+        if is_ayatan and (x.get('cyan_stars', 0) != 2 or x.get('amber_stars', 0) != 1):
+            continue
+        # skip non 'intact' relics or fishes
+        # use the list for other types
+        subtype = x.get('subtype')
+        if subtype not in G_HIST_SUBTYPES:
+            subtype_found[subtype] = 0
+            continue
+        # timestamps are epoch seconds, as stored in the DB
+        rv.append((parse_iso_epoch(x['datetime']), int(x['volume']), int(x['min_price']), int(x['max_price']), int(x['open_price']), int(x['closed_price']), float(x['avg_price']), float(x['wa_price']), float(x['median']), float(x.get('moving_avg', 0.0))))
     # consistency check
-    uniq_dates = {}
-    for x in rv:
-        uniq_dates[x[0]] = None
-    if len(uniq_dates) != len(rv):
+    if len(set(x[0] for x in rv)) != len(rv):
         fname = f'{item_name}.json'
         with open(fname, 'w') as f:
             f.write(data)
@@ -162,72 +518,591 @@ def parse_attrs(data):
         rv[y.lower()] = 1
     return list(rv.keys())
 
+# simple thread safe token bucket, shared by all the
+# fetching workers to enforce the requests per second budget
+class TokenBucket:
+    def __init__(self, rate, capacity=1.0):
+        # a rate <= 0 means no limit at all
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        # no token is handed out before this
+        # time, i.e. when told to Retry-After
+        self.paused_until = 0.0
+        self.n_acquired = 0
+        self.first = None
+
+    # blocks until a token is available and returns
+    # the time spent sleeping
+    def acquire(self):
+        slept = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate <= 0.0:
+                    break
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.last)*self.rate)
+                    self.last = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        break
+                    wait = (1.0 - self.tokens)/self.rate
+            time.sleep(wait)
+            slept += wait
+        with self.lock:
+            self.n_acquired += 1
+            if self.first is None:
+                self.first = time.monotonic()
+        return slept
+
+    # outcome of a request, status is None for
+    # connection errors; only Retry-After matters here
+    def feedback(self, status, latency, retry_after=None):
+        if retry_after:
+            with self.lock:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    # requests per second actually made so far
+    def effective_rate(self):
+        with self.lock:
+            if self.first is None:
+                return 0.0
+            elapsed = time.monotonic() - self.first
+            return self.n_acquired/elapsed if elapsed > 0.0 else 0.0
+
+# AIMD on the rate of the bucket: additive increase while the
+# responses are healthy, multiplicative decrease on 429/5xx and
+# errors and a gentler one when the latency builds up
+class AdaptiveTokenBucket(TokenBucket):
+    def __init__(self, rate, min_rate=G_ADAPTIVE_MIN_RATE, max_rate=G_ADAPTIVE_MAX_RATE, capacity=1.0):
+        super().__init__(min(max(rate, min_rate), max_rate), capacity)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.latency = None
+        self.min_latency = None
+        self.last_decrease = 0.0
+
+    def decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease >= G_ADAPTIVE_HOLD:
+            self.rate = max(self.min_rate, self.rate*factor)
+            self.last_decrease = now
+
+    def feedback(self, status, latency, retry_after=None):
+        super().feedback(status, latency, retry_after)
+        with self.lock:
+            if status is None or status == 429 or status >= 500:
+                self.decrease(G_ADAPTIVE_DECREASE)
+                return None
+            if status >= 400:
+                return None
+            # moving average of the latency
+            self.latency = latency if self.latency is None else 0.8*self.latency + 0.2*latency
+            if self.min_latency is None or self.latency < self.min_latency:
+                self.min_latency = self.latency
+            if self.latency > G_ADAPTIVE_SLOW_FACTOR*self.min_latency:
+                self.decrease(G_ADAPTIVE_SLOW_DECREASE)
+            else:
+                self.rate = min(self.max_rate, self.rate + G_ADAPTIVE_STEP)
+
+# thread safe metrics of an update run: timings of each phase
+# (seconds, reported as percentiles) and plain counters
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = datetime.datetime.now(datetime.timezone.utc)
+            self.tm_start = time.monotonic()
+            self.phases = {}
+            self.counters = {}
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            self.phases.setdefault(phase, []).append(seconds)
+
+    def add(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def report(self):
+        with self.lock:
+            wall = time.monotonic() - self.tm_start
+            rv = {'started': self.started.isoformat(), 'wall_s': wall, 'workers': G_FETCH_WORKERS, 'phases': {}, 'counters': dict(self.counters)}
+            for k, v in self.phases.items():
+                v = sorted(v)
+                # nearest rank percentiles
+                pct = lambda p: v[min(len(v)-1, int(p*len(v)))]
+                rv['phases'][k] = {'count': len(v), 'total_s': sum(v), 'p50_s': pct(0.5), 'p95_s': pct(0.95), 'p99_s': pct(0.99), 'max_s': v[-1]}
+        c = rv['counters']
+        t_insert = rv['phases'].get('db_insert', {}).get('total_s', 0.0)
+        rv['rates'] = {
+            'req_per_s': c.get('requests', 0)/wall if wall > 0.0 else 0.0,
+            'bytes_per_s': c.get('bytes_in', 0)/wall if wall > 0.0 else 0.0,
+            'rows_inserted_per_s': c.get('rows_inserted', 0)/wall if wall > 0.0 else 0.0,
+            'db_rows_per_s': c.get('rows_inserted', 0)/t_insert if t_insert > 0.0 else 0.0,
+            # the sleeps are summed over the workers, as a
+            # share of the time all of them have been running
+            'throttle_sleep_frac': c.get('throttle_sleep_worker_s', 0.0)/(wall*G_FETCH_WORKERS) if wall > 0.0 else 0.0,
+            'backoff_sleep_frac': c.get('backoff_sleep_worker_s', 0.0)/(wall*G_FETCH_WORKERS) if wall > 0.0 else 0.0,
+        }
+        return rv
+
+    def write(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+G_METRICS = RunMetrics()
+
+def get_wfm_limiter():
+    # nothing to throttle when replaying from the cache
+    if G_WFM_CACHE is not None and G_WFM_CACHE.replay:
+        return TokenBucket(0.0)
+    rate = 1.0/G_SLEEP_THROTTLE if G_SLEEP_THROTTLE > 0.0 else 0.0
+    if G_ADAPTIVE:
+        return AdaptiveTokenBucket(rate if rate > 0.0 else G_ADAPTIVE_MAX_RATE)
+    return TokenBucket(rate)
+
+# content addressed on-disk cache of the raw API responses: bodies are
+# stored once under objects/ named by their sha256, while refs/ maps
+# each url (hashed as well) to its body, fetch time and validators;
+# bodies are evicted least recently used first when over max_size
+class WebCache:
+    def __init__(self, path, max_size=G_CACHE_MAX_SIZE, compress=False, replay=False):
+        self.path = path
+        self.max_size = max_size
+        self.compress = compress
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.size = None
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(path, 'refs'), exist_ok=True)
+
+    def ref_path(self, str_url):
+        return os.path.join(self.path, 'refs', hashlib.sha256((G_WFM_API_URL + str_url).encode('utf-8')).hexdigest())
+
+    def write_file(self, fname, data):
+        # write then rename so that concurrent
+        # readers never see partial files
+        fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(fname))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_name, fname)
+
+    def ttl(self, str_url):
+        for r, t in G_CACHE_TTLS:
+            if r.match(str_url):
+                return t
+        return 0
+
+    def is_fresh(self, str_url, ref):
+        return time.time() - ref['ts'] < self.ttl(str_url)
+
+    # returns (ref, data) or (None, None) if not cached
+    def get(self, str_url):
+        ref_name = self.ref_path(str_url)
+        try:
+            with open(ref_name, 'rb') as f:
+                ref = json.loads(f.read())
+        except (OSError, ValueError):
+            return None, None
+        try:
+            return ref, self.load(ref)
+        except FileNotFoundError:
+            # the body has been evicted, drop the ref as well
+            self.remove_file(ref_name)
+            return None, None
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    def remove_file(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    # body of a ref
+    def load(self, ref):
+        obj_name = os.path.join(self.path, 'objects', ref['object'])
+        with open(obj_name, 'rb') as f:
+            data = f.read()
+        # the access time drives the eviction
+        os.utime(obj_name)
+        if ref['object'].endswith('.z'):
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    # all the refs stored, whichever the api url
+    def refs(self):
+        rv = []
+        with os.scandir(os.path.join(self.path, 'refs')) as it:
+            for e in it:
+                try:
+                    with open(e.path, 'rb') as f:
+                        rv.append(json.loads(f.read()))
+                except (OSError, ValueError):
+                    continue
+        return rv
+
+    def put(self, str_url, data, etag=None, last_modified=None):
+        b_data = data.encode('utf-8')
+        obj = hashlib.sha256(b_data).hexdigest()
+        if self.compress:
+            obj += '.z'
+            b_data = zlib.compress(b_data)
+        obj_name = os.path.join(self.path, 'objects', obj)
+        if os.path.exists(obj_name):
+            os.utime(obj_name)
+        else:
+            self.write_file(obj_name, b_data)
+            self.add_size(len(b_data))
+        self.touch(str_url, obj, etag, last_modified)
+
+    # (re)writes the ref of the url, marking it as just fetched
+    def touch(self, str_url, obj, etag=None, last_modified=None):
+        ref = {'url': str_url, 'object': obj, 'ts': time.time(), 'etag': etag, 'last_modified': last_modified}
+        self.write_file(self.ref_path(str_url), json.dumps(ref).encode('utf-8'))
+
+    def objects(self):
+        rv = []
+        with os.scandir(os.path.join(self.path, 'objects')) as it:
+            for e in it:
+                if e.is_file():
+                    st = e.stat()
+                    rv.append((st.st_mtime, st.st_size, e.path))
+        return rv
+
+    def add_size(self, n):
+        with self.lock:
+            if self.size is None:
+                self.size = sum(x[1] for x in self.objects())
+            else:
+                self.size += n
+            if self.size <= self.max_size:
+                return None
+            # evict down to 90% of the max size
+            objs = sorted(self.objects())
+            self.size = sum(x[1] for x in objs)
+            for mtime, sz, fname in objs:
+                if self.size <= self.max_size*0.9:
+                    break
+                try:
+                    os.remove(fname)
+                except OSError:
+                    continue
+                self.size -= sz
+            self.sweep_refs()
+
+    # removes the refs whose body is gone (or unreadable
+    # ones), they would only ever be misses
+    def sweep_refs(self):
+        objs = set(os.path.basename(x[2]) for x in self.objects())
+        with os.scandir(os.path.join(self.path, 'refs')) as it:
+            for e in it:
+                # skip the files being written (see write_file)
+                if len(e.name) != 64:
+                    continue
+                try:
+                    with open(e.path, 'rb') as f:
+                        if json.loads(f.read())['object'] in objs:
+                            continue
+                except FileNotFoundError:
+                    continue
+                except (OSError, ValueError, KeyError):
+                    pass
+                self.remove_file(e.path)
+
+# the pool can be shared across threads, maxsize should
+# match the number of workers using it
+def get_wfm_pool(maxsize=1):
+    return urllib3.connection_from_url(G_WFM_API_URL, maxsize=maxsize, block=True)
+
+# non successful reply of WarFrame Market, retry_after
+# is in seconds (None if not specified)
+class WfmHttpError(Exception):
+    def __init__(self, str_url, status, retry_after=None):
+        super().__init__(f'HTTP {status} for {str_url}')
+        self.status = status
+        self.retry_after = retry_after
+
+# Retry-After is either in seconds or an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        dt = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (dt - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+# failures worth retrying, as opposed to
+# i.e. unexpected payloads
+def is_transient_error(e):
+    if isinstance(e, WfmHttpError):
+        return e.status == 429 or e.status >= 500
+    return isinstance(e, (urllib3.exceptions.HTTPError, OSError))
+
 def get_wfm_webapi(str_url, https_cp):
-    f = https_cp.urlopen('GET', str_url, headers={'User-Agent': G_WFM_USER_AGENT, 'crossplay' : 'true'})
+    data, _, _ = get_wfm_webapi_cond(str_url, https_cp)
+    return data
+
+# conditional GET when any of the validators is set, returns
+# (data, etag, last_modified) with data None if not modified;
+# goes through the response cache when enabled
+def get_wfm_webapi_cond(str_url, https_cp, etag=None, last_modified=None):
+    cache = G_WFM_CACHE
+    ref, c_data = (None, None)
+    if cache is not None:
+        ref, c_data = cache.get(str_url)
+        if ref is None and cache.replay:
+            raise LookupError(f'{str_url} not found in cache {cache.path} (replay mode)')
+        if ref is not None and (cache.replay or cache.is_fresh(str_url, ref)):
+            G_METRICS.add('cache_hits')
+            if etag and etag == ref['etag']:
+                return None, etag, last_modified
+            return c_data, ref['etag'], ref['last_modified']
+    headers = {'User-Agent': G_WFM_USER_AGENT, 'crossplay' : 'true'}
+    # without validators of its own the caller
+    # still wants the body, so the cached one
+    # can be revalidated instead
+    c_validate = ref is not None and not etag and not last_modified
+    if c_validate:
+        etag, last_modified = ref['etag'], ref['last_modified']
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    tm_start = time.monotonic()
+    f = https_cp.urlopen('GET', str_url, headers=headers)
     f.read()
-    return f.data.decode('utf-8')
+    G_METRICS.observe('http', time.monotonic()-tm_start)
+    G_METRICS.add('requests')
+    G_METRICS.add('bytes_in', len(f.data))
+    if f.status not in (200, 304):
+        raise WfmHttpError(str_url, f.status, parse_retry_after(f.headers.get('Retry-After')))
+    if f.status == 304:
+        G_METRICS.add('not_modified')
+        if ref is not None and ref['etag'] == etag and ref['last_modified'] == last_modified:
+            cache.touch(str_url, ref['object'], etag, last_modified)
+        if c_validate:
+            return c_data, etag, last_modified
+        return None, etag, last_modified
+    data = f.data.decode('utf-8')
+    rv_etag, rv_last_modified = f.headers.get('ETag'), f.headers.get('Last-Modified')
+    if cache is not None:
+        cache.put(str_url, data, rv_etag, rv_last_modified)
+    return data, rv_etag, rv_last_modified
+
+# throttled request, reporting its outcome to the limiter
+def get_wfm_webapi_limited(str_url, https_cp, limiter, etag=None, last_modified=None):
+    G_METRICS.add('throttle_sleep_worker_s', limiter.acquire())
+    tm_start = time.monotonic()
+    try:
+        rv = get_wfm_webapi_cond(str_url, https_cp, etag, last_modified)
+    except WfmHttpError as e:
+        limiter.feedback(e.status, time.monotonic()-tm_start, e.retry_after)
+        raise
+    except (urllib3.exceptions.HTTPError, OSError):
+        limiter.feedback(None, time.monotonic()-tm_start)
+        raise
+    limiter.feedback(200, time.monotonic()-tm_start)
+    return rv
 
-def get_hist_stats(item_name, https_cp, query_metadata):
+# returns (rows, tags, subtypes, (etag, last_modified)), rows
+# are None if the statistics have not been modified
+def get_hist_stats(item_name, https_cp, query_metadata, limiter, validators=(None, None)):
     # sample api historical data
     # https://api.warframe.market/v2/items/mirage_prime_systems_blueprint/statistics
-    str_url = f'https://api.warframe.market/v1/items/{item_name}/statistics'
-    data = get_wfm_webapi(str_url, https_cp)
+    str_url = f'/v1/items/{item_name}/statistics'
+    data, etag, last_modified = get_wfm_webapi_limited(str_url, https_cp, limiter, *validators)
+    if data is None:
+        return (None, [], {}, (etag, last_modified))
     tags = []
     if query_metadata:
-        time.sleep(G_SLEEP_THROTTLE)
-        str_url = f'https://api.warframe.market/v2/items/{item_name}'
-        data_attrs = get_wfm_webapi(str_url, https_cp)
+        str_url = f'/v2/items/{item_name}'
+        data_attrs, _, _ = get_wfm_webapi_limited(str_url, https_cp, limiter)
         tags = parse_attrs(data_attrs)
+    tm_start = time.monotonic()
     phs = parse_hist_stats(data, item_name)
-    return (phs[0], tags, phs[1])
+    G_METRICS.observe('parse', time.monotonic()-tm_start)
+    G_METRICS.add('rows_parsed', len(phs[0]))
+    return (phs[0], tags, phs[1], (etag, last_modified))
+
+# producer side of the update: fetches and parses the items on the
+# workers and yields (name, (rows, tags, subtypes, validators), error,
+# elapsed, attempts) keeping a bounded number of items in flight
+def fetch_hist_data(item_names, items_tags, items_validators={}, limiter=None):
+    # create the HTTPS pool here, it's shared by all
+    # the workers and so is the rate limiter
+    https_cp = get_wfm_pool(G_FETCH_WORKERS)
+    if limiter is None:
+        limiter = get_wfm_limiter()
+    def fetch_fn(nm, q_nm):
+        tm_start = time.monotonic()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                # optimization: only query metadata when we don't have tags
+                rv = get_hist_stats(q_nm, https_cp, nm not in items_tags, limiter, items_validators.get(nm, (None, None)))
+                G_METRICS.observe('item', time.monotonic()-tm_start)
+                return rv, time.monotonic()-tm_start, attempts
+            except Exception as e:
+                if attempts > G_FETCH_RETRIES or not is_transient_error(e):
+                    e.attempts = attempts
+                    raise
+                retry_after = getattr(e, 'retry_after', None) or 0.0
+                G_METRICS.add('retries')
+            # only this worker backs off, the others carry
+            # on meanwhile unless told to Retry-After
+            backoff = max(G_FETCH_BACKOFF*(2**(attempts-1))*random.uniform(1.0, 1.5), retry_after)
+            G_METRICS.add('backoff_sleep_worker_s', backoff)
+            time.sleep(backoff)
+    it_items = iter(item_names.items())
+    pending = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=G_FETCH_WORKERS) as executor:
+        while True:
+            for nm, q_nm in itertools.islice(it_items, 2*G_FETCH_WORKERS - len(pending)):
+                pending[executor.submit(fetch_fn, nm, q_nm)] = nm
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for fut in done:
+                nm = pending.pop(fut)
+                try:
+                    rv, tm_elapsed, attempts = fut.result()
+                except Exception as e:
+                    yield (nm, None, e, 0.0, getattr(e, 'attempts', 1))
+                else:
+                    yield (nm, rv, None, tm_elapsed, attempts)
 
-def store_hist_data(item_names, force_metadata=False):
-    print("\tFetching:")
-    all_items = {}
-    n_digits = len(str(len(item_names.keys())))
+# writer side of the update: stores the items in batches of
+# G_DB_BATCH_SIZE, each batch in its own transaction along with
+# the checkpoint of its items; when resuming item_names is
+# ignored and the items not done by the last update are used
+def store_hist_data(item_names, force_metadata=False, skip_current=True, resume=False):
     # have to init the DB connection here
     # to optimize skipping existing tags
+    G_METRICS.reset()
     db = sqlite3.connect(G_DB_NAME)
     db_setup(db)
+    db_migrate(db)
+    # batches are timed as a whole, commit included; the items
+    # are only checkpointed as done once their rows are in
+    def insert_batch(batch, batch_attempts):
+        tm_start = time.monotonic()
+        rv_stats = db_insert_raw_data(db, batch)
+        for nm, attempts in batch_attempts.items():
+            db_checkpoint_item(db, nm, attempts)
+        db.commit()
+        G_METRICS.observe('db_insert', time.monotonic()-tm_start)
+        G_METRICS.add('rows_inserted', sum(rv_stats.values()))
+        return rv_stats
+    if resume:
+        item_names = db_checkpoint_pending(db)
+        print("\tResuming", len(item_names), "items")
+    else:
+        db_checkpoint_start(db, item_names)
     items_tags = db_fetch_names_tags(db) if not force_metadata else {}
-    cnt = 0
-    # create the HTTPS pool here
-    https_cp = urllib3.HTTPSConnectionPool('api.warframe.market')
-    for nm, q_nm in item_names.items():
-        cnt += 1
-        print("[{count:{fill}{align}{width}}/{total}]".format(count=cnt, total=len(item_names), fill=' ', align='>', width=n_digits), end='\t')
-        print(nm, end='...')
+    max_ts_interval = db_fetch_max_ts(db)
+    if not max_ts_interval:
+        max_ts_interval = 0
+    # skip what is already current (i.e. when resuming an
+    # interrupted run or re-running on the same day) and send
+    # the validators of the last fetch for the remaining ones
+    items_validators = {}
+    if skip_current:
+        all_names = item_names
         tm_start = time.monotonic()
-        try:
-            # optimization: only query metadata when we don't have tags
-            all_items[nm] = get_hist_stats(q_nm, https_cp, nm not in items_tags)
-        except Exception as e:
-            print("Error, carrying on (", e, ")")
-        else:
-            # this is not great - but it does work...
-            tm_end = time.monotonic()
-            print('done', tm_end-tm_start, 's', "(" + str(len(all_items[nm][0])) + " entries)")
-        finally:
-            tm_end = time.monotonic()
-            sleep_throttle = G_SLEEP_THROTTLE - (tm_end - tm_start)
-            if sleep_throttle > 0.0:
-                time.sleep(sleep_throttle)
-    # perform insertion of all data
-    rv, max_ts_interval = db_insert_raw_data(db, all_items)
-    db.close()
-    # prepare return query stats and
-    # warning items
+        item_names, items_validators = plan_hist_fetch(db, all_names)
+        G_METRICS.observe('plan', time.monotonic()-tm_start)
+        n_skip = len(all_names) - len(item_names)
+        if n_skip > 0:
+            print("\tSkipping", n_skip, "items already up to date")
+            for nm in all_names:
+                if nm not in item_names:
+                    db_checkpoint_item(db, nm, 0)
+            db.commit()
+    print("\tFetching:")
+    n_digits = len(str(len(item_names.keys())))
+    cnt = 0
+    rv = {}
     rv_q = {}
     rv_subtypes = {}
-    for nm in all_items.keys():
-        rv_q[nm] = len(all_items[nm][0])
-        if bool(all_items[nm][2]):
-            rv_subtypes[nm] = all_items[nm][2]
+    batch = {}
+    batch_attempts = {}
+    interrupted = False
+    limiter = get_wfm_limiter()
+    try:
+        try:
+            for nm, hist, err, tm_elapsed, attempts in fetch_hist_data(item_names, items_tags, items_validators, limiter):
+                cnt += 1
+                print("[{count:{fill}{align}{width}}/{total}]".format(count=cnt, total=len(item_names), fill=' ', align='>', width=n_digits), end='\t')
+                print(nm, end='...')
+                if err is not None:
+                    G_METRICS.add('errors')
+                    print("Error after", attempts, "attempt(s), carrying on (", err, ")")
+                    db_checkpoint_item(db, nm, attempts, err)
+                    continue
+                batch_attempts[nm] = attempts
+                if hist[0] is None:
+                    # still log the fetch so that it's
+                    # skipped for the rest of the day
+                    print('not modified', tm_elapsed, 's')
+                    batch[nm] = ([], [], {}, hist[3])
+                    continue
+                print('done', tm_elapsed, 's', "(" + str(len(hist[0])) + " entries)")
+                # prepare return query stats and
+                # warning items
+                rv_q[nm] = len(hist[0])
+                if bool(hist[2]):
+                    rv_subtypes[nm] = hist[2]
+                batch[nm] = hist
+                if len(batch) >= G_DB_BATCH_SIZE:
+                    rv.update(insert_batch(batch, batch_attempts))
+                    batch = {}
+                    batch_attempts = {}
+        except KeyboardInterrupt:
+            # keep what has been fetched so far
+            interrupted = True
+        if limiter.n_acquired > 0:
+            print("\tEffective rate:", round(limiter.effective_rate(), 2), "req/s")
+            if G_ADAPTIVE:
+                print("\tLast rate limit:", round(limiter.rate, 2), "req/s")
+        if batch:
+            rv.update(insert_batch(batch, batch_attempts))
+        else:
+            # the checkpoint of the items
+            # failed since the last batch
+            db.commit()
+    finally:
+        # the batches committed so far have to reach the summary
+        # even if the run failed, a half written one is dropped
+        db.rollback()
+        tm_start = time.monotonic()
+        nm_id = db_names_ids(db, G_DB_ITEMS_NAME)
+        db_refresh_summary(db, [nm_id[k] for k, v in rv.items() if v > 0])
+        G_METRICS.observe('summary', time.monotonic()-tm_start)
+        G_METRICS.add('items', cnt)
+        db.close()
+    if interrupted:
+        raise KeyboardInterrupt
     return (rv, rv_q, rv_subtypes, max_ts_interval)
 
 def get_items_list(search_nm, get_all=False):
     str_url = '/v2/items'
-    https_cp = urllib3.HTTPSConnectionPool('api.warframe.market')
+    https_cp = get_wfm_pool()
     data = get_wfm_webapi(str_url, https_cp)
     jdata = json.loads(data)
     if get_all:
@@ -245,7 +1120,89 @@ def get_items_list(search_nm, get_all=False):
                 rv[uniform_str(k['i18n']['en']['name'])] = k['slug']
     return rv
 
-def do_extract(search_nm, e_values, *, tags=[], wildcard_ws=False, n_days=G_N_DAYS_HIST):
+# LIKE patterns of the searched names, bound as a JSON
+# array so that the query text doesn't depend on them
+def build_name_patterns(search_nm, wildcard_ws):
+    rv = []
+    for n in search_nm:
+        if wildcard_ws:
+            n_v = re.split(r'\s+', n)
+            n = '%'.join(n_v)
+        rv.append('%' + n + '%')
+    return json.dumps(rv)
+
+# item ids whose name is LIKE any of the :names patterns; with
+# fts those are resolved via the trigram index (the CROSS JOIN
+# ensures each pattern is looked up in the index)
+def build_names_query(fts):
+    if fts:
+        return """
+    SELECT  f.rowid
+    FROM    json_each(:names) n
+    CROSS JOIN """ + G_DB_ITEMS_FTS + """ f
+    ON      (f.name LIKE n.value)"""
+    return """
+    SELECT  i_n.rowid
+    FROM    items i_n
+    JOIN    json_each(:names) n
+    ON      (i_n.name LIKE n.value)"""
+
+# in memory index of the tags: one bitset per (lowercase) tag name,
+# bit n being set when the item with rowid n has the tag, so that
+# filtering by tags is a few bitwise operations; it is reloaded
+# when another connection has committed to the db
+class TagIndex:
+    def __init__(self, db):
+        self.db = db
+        self.version = None
+        self.tags = {}
+
+    def refresh(self):
+        cur = self.db.cursor()
+        version = cur.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.version:
+            return None
+        ids = {}
+        for name, item_id in cur.execute("SELECT LOWER(t.name), ia.item_id FROM " + G_DB_ITEMS_TAGS + " ia JOIN " + G_DB_TAGS_NAME + " t ON (ia.tag_id=t.rowid)"):
+            ids.setdefault(name, []).append(item_id)
+        self.tags = {}
+        for name, l in ids.items():
+            bits = np.zeros(max(l)+1, dtype=bool)
+            bits[l] = True
+            self.tags[name] = int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+        self.version = version
+        return None
+
+    # ids of the items having all the tags (andor) or any of them
+    def item_ids(self, tags, andor=True):
+        self.refresh()
+        rv = None
+        for t in dict.fromkeys(x.lower() for x in tags):
+            bits = self.tags.get(t, 0)
+            if rv is None:
+                rv = bits
+            else:
+                rv = (rv & bits) if andor else (rv | bits)
+        if not rv:
+            return []
+        bits = np.frombuffer(rv.to_bytes((rv.bit_length()+7)//8, 'little'), dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(bits, bitorder='little')).tolist()
+
+# ids of the items matching tags, via the tag index
+# of the read-only connection of the calling thread
+def db_tag_ids(db, tags, andor=True):
+    if not tags:
+        return []
+    idx = getattr(G_DB_RO_LOCAL, 'tag_index', None)
+    if (idx is None) or (idx.db is not db):
+        idx = TagIndex(db)
+        G_DB_RO_LOCAL.tag_index = idx
+    return idx.item_ids(tags, andor)
+
+# returns the query and its parameters for do_extract; all the
+# search terms are bound, so the query text only depends on the
+# extracted values and on the kind of filters
+def build_extract_query(search_nm, e_values, *, tags=[], tag_ids=[], wildcard_ws=False, n_days=G_N_DAYS_HIST, fts=False, int_ts=False):
     query = """
 SELECT  i.name as name, h.ts as ts
 """
@@ -253,54 +1210,51 @@ SELECT  i.name as name, h.ts as ts
     for v in e_values:
         values_q += ", h." + v + " as " + v
     query += values_q
-    query += """
+    query += """, i.rowid as item_id
 FROM    items i
 JOIN    hist h
-ON      (i.rowid=h.id)"""
-    if tags:
-        query_tags = """
-JOIN    (
-    SELECT  ia.item_id
-    FROM    items_attrs ia
-    JOIN    tags t
-    ON (ia.tag_id=t.rowid)
-    WHERE   1=1
-    AND     LOWER(t.name) IN ("""
-        query_tags += ', '.join(["LOWER('" + x + "')" for x in tags])
-        query_tags += """)
-    GROUP BY ia.item_id"""
-        query_tags += """
-    HAVING COUNT(0)>=""" + str(len(tags))
-        query_tags += """
-) t_ ON (i.rowid=t_.item_id)
-"""
-        query += query_tags
-    query += """WHERE   1=1
-AND     (
-        1=0
-"""
-    items_q = ""
-    for n in search_nm:
-        if wildcard_ws:
-            n_v = re.split(r'\s+', n)
-            n = '%'.join(n_v)
-        items_q += "\tOR i.name LIKE '%" + n + "%'\n"
+ON      (i.rowid=h.id)
+WHERE   1=1"""
     # if we have tags do select even if search_nm is empty
-    if tags and not search_nm:
-        items_q = "\tOR 1=1\n"
-    query += items_q
-    query += ")"
+    if not (tags and not search_nm):
+        query += """
+AND     i.rowid IN (""" + build_names_query(fts) + """
+)"""
+    query += """
+AND     (
+        json_array_length(:tags)=0
+        OR i.rowid IN (SELECT value FROM json_each(:tag_ids))
+)"""
     if n_days > 0:
         query += """
-AND     h.ts > DATE('now', ?)"""
-    interval_q = "-" + str(n_days) + " days"
-    db = sqlite3.connect(G_DB_NAME_RO, uri=True)
-    db_setup(db)
+AND     """ + build_ts_since("h.ts", int_ts)
+    params = {
+        'names': build_name_patterns(search_nm, wildcard_ws),
+        'tags': json.dumps(tags),
+        'tag_ids': json.dumps(tag_ids),
+        'interval': "-" + str(n_days) + " days",
+    }
+    return query, params
+
+# cancel_fn, if set, is polled while the query runs and
+# interrupts it (raising sqlite3.OperationalError) when true;
+# connections are shared, hence always reset the handler
+def db_set_cancel(db, cancel_fn):
+    if cancel_fn:
+        db.set_progress_handler(lambda: 1 if cancel_fn() else 0, 1000)
+    else:
+        db.set_progress_handler(None, 0)
+    return None
+
+def do_extract(search_nm, e_values, *, tags=[], wildcard_ws=False, n_days=G_N_DAYS_HIST, cancel_fn=None):
+    db = db_ro()
+    db_set_cancel(db, cancel_fn)
+    query, params = build_extract_query(search_nm, e_values, tags=tags, tag_ids=db_tag_ids(db, tags), wildcard_ws=wildcard_ws, n_days=n_days, fts=db_has_table(db, G_DB_ITEMS_FTS), int_ts=db_int_ts(db))
     cur = db.cursor()
-    ri = cur.execute(query) if n_days <= 0 else cur.execute(query, (interval_q,))
+    ri = cur.execute(query, params)
     rv = {}
     for v in ri:
-        cd = datetime.datetime.fromisoformat(v[1])
+        cd = db_ts_to_datetime(v[1])
         ci = v[0]
         if cd not in rv:
             rv[cd] = {}
@@ -308,28 +1262,67 @@ AND     h.ts > DATE('now', ?)"""
             rv[cd][ci] = {}
         for i in range(len(e_values)):
             rv[cd][ci][e_values[i]] = v[2+i]
-    db.close()
     return rv
 
+# columnar version of do_extract, returns (ts, items, values) where
+# ts is the sorted datetime64 (UTC) index, items the names in order of
+# appearance and values[<value>] a float matrix of items x ts, NaN where
+# there's no data; each row is the array of a given item
+def do_extract_columns(search_nm, e_values, *, tags=[], wildcard_ws=False, n_days=G_N_DAYS_HIST, cancel_fn=None):
+    db = db_ro()
+    db_set_cancel(db, cancel_fn)
+    query, params = build_extract_query(search_nm, e_values, tags=tags, tag_ids=db_tag_ids(db, tags), wildcard_ws=wildcard_ws, n_days=n_days, fts=db_has_table(db, G_DB_ITEMS_FTS), int_ts=db_int_ts(db))
+    cur = db.cursor()
+    rows = cur.execute(query, params).fetchall()
+    if not rows:
+        return np.array([], dtype='datetime64[s]'), [], {v: np.empty((0, 0)) for v in e_values}
+    cols = list(zip(*rows))
+    del rows
+    # only parse each distinct timestamp once
+    items = {x: i for i, x in enumerate(dict.fromkeys(cols[0]))}
+    ts_epoch = {x: db_ts_to_epoch(x) for x in dict.fromkeys(cols[1])}
+    item_pos = np.fromiter((items[x] for x in cols[0]), dtype=np.int64, count=len(cols[0]))
+    ts_all = np.fromiter((ts_epoch[x] for x in cols[1]), dtype=np.int64, count=len(cols[1]))
+    ts, ts_pos = np.unique(ts_all, return_inverse=True)
+    values = {}
+    for i in range(len(e_values)):
+        m = np.full((len(items), len(ts)), np.nan)
+        m[item_pos, ts_pos] = np.array(cols[2+i], dtype=np.float64)
+        values[e_values[i]] = m
+    return ts.astype('datetime64[s]'), list(items.keys()), values
+
 def do_extract_tags():
-    db = sqlite3.connect(G_DB_NAME_RO, uri=True)
-    db_setup(db)
+    db = db_ro()
+    db_set_cancel(db, None)
     cur = db.cursor()
     ri = cur.execute("SELECT name FROM " + G_DB_TAGS_NAME + " GROUP BY name")
     rv = []
     for v in ri:
         rv.append(v[0])
-    db.close()
     filters = ['---']
     return [x for x in rv if (x not in filters)]
 
-def do_summary(n_days=5, min_volume=24, min_price=25, search_nm=[], search_tags=[], tags_andor=True, exclude_sets=True):
-    items_q = ""
-    for n in search_nm:
-        n_v = re.split(r'\s+', n)
-        n = '%'.join(n_v)
-        items_q += "    OR x.name LIKE '%" + n + "%'\n"
-    query = """
+# returns the query and its parameters for do_summary
+# when rollup is set the values are read from the summary
+# table rather than aggregated from hist; as per above all the
+# search terms are bound
+def build_summary_query(n_days=5, min_volume=24, min_price=25, search_nm=[], search_tags=[], tag_ids=[], exclude_sets=True, rollup=False, fts=False, int_ts=False):
+    if rollup:
+        query = """
+select x.name, x.price, x.volume, x.change
+from (
+    SELECT i.ROWID, i.name, s.price, s.volume, s.change
+    FROM	items i
+    JOIN	summary s
+    ON		(i.ROWID=s.id)
+    WHERE	1=1
+    AND		s.days=:days"""
+        if search_nm:
+            query += """
+    AND		i.ROWID IN (""" + build_names_query(fts) + """
+    )"""
+    else:
+        query = """
 select x.name, x.price, x.volume, x.change
 from (
     SELECT i.ROWID, i.name, avg(ts_x.price) as price, avg(ts_x.volume) as volume, 100.0 + 100.0*avg((h_max.avg - h_min.avg)/h_min.avg) as 'change'
@@ -338,7 +1331,13 @@ from (
         SELECT 	h.id, min(h.ts) as min_ts, max(h.ts) as max_ts, avg(volume) as volume, avg(avg) as price
         FROM	hist h
         WHERE	1=1
-        AND		h.ts > DATE('now', ?)
+        AND		""" + build_ts_since("h.ts", int_ts)
+        # only aggregate the searched items
+        if search_nm:
+            query += """
+        AND		h.id IN (""" + build_names_query(fts) + """
+        )"""
+        query += """
         GROUP BY	h.id
     ) ts_x
     ON		(i.ROWID=ts_x.id)
@@ -347,114 +1346,346 @@ from (
     JOIN	hist h_max
     ON		(i.ROWID=h_max.id AND h_max.ts=ts_x.max_ts)
     WHERE	1=1"""
-    if exclude_sets:
-        query += "    AND   NOT i.name LIKE '%set'"
     query += """
-    GROUP BY	i.ROWID, i.name
+    AND		(:all_sets OR NOT i.name LIKE '%set')"""
+    if not rollup:
+        query += """
+    GROUP BY	i.ROWID, i.name"""
+    query += """
 ) x
-"""
-    if search_tags:
-        count_tags = str(len(search_tags)) if tags_andor else '1'
-        query_tags = """JOIN    (
-    SELECT  ia.item_id
-    FROM    items_attrs ia
-    JOIN    tags t
-    ON (ia.tag_id=t.rowid)
-    WHERE   1=1
-    AND     LOWER(t.name) IN ("""
-        query_tags += ', '.join(["LOWER('" + x + "')" for x in search_tags])
-        query_tags += """)
-    GROUP BY ia.item_id"""
-        query_tags += """
-    HAVING COUNT(0)>=""" + count_tags
-        query_tags += """
-) t_ ON (x.rowid=t_.item_id)
-"""
-        query += query_tags
-    query += """WHERE	1=1
-AND		x.volume >= ?
-AND		x.price >= ?
-AND(
-    1=?
-"""
-    query += items_q
-    query += """)
+WHERE	1=1
+AND		x.volume >= :min_volume
+AND		x.price >= :min_price
+AND		(
+    json_array_length(:tags)=0
+    OR x.rowid IN (SELECT value FROM json_each(:tag_ids))
+)
 ORDER BY	x.price DESC
 """
-    interval_q = "-" + str(n_days) + " days"
-    db = sqlite3.connect(G_DB_NAME_RO, uri=True)
-    db_setup(db)
+    params = {
+        'days': n_days,
+        'interval': "-" + str(n_days) + " days",
+        'all_sets': 0 if exclude_sets else 1,
+        'min_volume': min_volume,
+        'min_price': min_price,
+        'names': build_name_patterns(search_nm, True),
+        'tags': json.dumps(search_tags),
+        'tag_ids': json.dumps(tag_ids),
+    }
+    return query, params
+
+def do_summary(n_days=5, min_volume=24, min_price=25, search_nm=[], search_tags=[], tags_andor=True, exclude_sets=True, cancel_fn=None):
+    db = db_ro()
+    db_set_cancel(db, cancel_fn)
+    rollup = db_summary_current(db, n_days)
+    query, params = build_summary_query(n_days=n_days, min_volume=min_volume, min_price=min_price, search_nm=search_nm, search_tags=search_tags, tag_ids=db_tag_ids(db, search_tags, tags_andor), exclude_sets=exclude_sets, rollup=rollup, fts=db_has_table(db, G_DB_ITEMS_FTS), int_ts=db_int_ts(db))
     cur = db.cursor()
-    flag_search = 1 if len(search_nm) == 0 else 0
-    ri = cur.execute(query, (interval_q, min_volume, min_price, flag_search))
+    ri = cur.execute(query, params)
     rv = []
     for v in ri:
         rv.append((v[0], v[1], v[2], v[3]))
-    db.close()
     return rv
 
-def do_extract_printout(ev, e_values):
-    # find all the items we have managed to extract
-    all_items = {}
-    for k, v in ev.items():
-        for i in v.keys():
-            all_items[i] = 0
-    # first print header
-    print("timestamp", end='')
-    for i in all_items.keys():
+# prints the query plan and the timings of a given
+# query, to check it's driven by the indices
+def do_explain(query, params):
+    db = db_ro()
+    cur = db.cursor()
+    print("\tQuery:")
+    print(query.strip())
+    print("\tQuery plan:")
+    depth = {0: 0}
+    for r in cur.execute("EXPLAIN QUERY PLAN " + query, params):
+        depth[r[0]] = depth.get(r[1], 0) + 1
+        print("  "*(depth[r[0]]-1) + r[3])
+    tm_start = time.monotonic()
+    ri = cur.execute(query, params)
+    tm_first = time.monotonic()
+    n_rows = 0
+    for v in ri:
+        n_rows += 1
+    tm_end = time.monotonic()
+    print("\tTimings:")
+    print("execute", tm_first-tm_start, "s")
+    print("fetch", tm_end-tm_first, "s", "(" + str(n_rows) + " rows)")
+
+# opens the file (stdout if not set) the extraction is written to
+def open_output(fname, compress):
+    if compress:
+        if fname:
+            return gzip.open(fname, 'wt', newline='')
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode='wb'), newline='')
+    if fname:
+        return open(fname, 'w', newline='', buffering=1024*1024)
+    return sys.stdout
+
+# streams the extraction as CSV to out: the rows are read ordered by
+# timestamp G_EXPORT_FETCH_SIZE at a time and pivoted one timestamp at
+# a time, hence memory is bound by the number of items
+def do_extract_stream(out, search_nm, e_values, *, tags=[], n_days=G_N_DAYS_HIST):
+    db = db_ro()
+    db_set_cancel(db, None)
+    query, params = build_extract_query(search_nm, e_values, tags=tags, tag_ids=db_tag_ids(db, tags), n_days=n_days, fts=db_has_table(db, G_DB_ITEMS_FTS), int_ts=db_int_ts(db))
+    cur = db.cursor()
+    # first get all the items for the header
+    ri = cur.execute("SELECT name FROM (" + query + ") GROUP BY name ORDER BY MIN(item_id)", params)
+    items = {}
+    for v in ri:
+        items[v[0]] = len(items)
+    wr = csv.writer(out, lineterminator='\n')
+    header = ["timestamp"]
+    for i in items.keys():
         for v in e_values:
-            print("," + i + " [" + v + "]", sep='', end='')
-    print()
-    # lambda to lookup values
-    def lookup_fn(ts, item, val):
-        if ts not in ev:
-            return None
-        if item not in ev[ts]:
-            return None
-        if val not in ev[ts][item]:
-            return None
-        return ev[ts][item][val]
-    # finally print out everything
-    for t in ev.keys():
-        print(t, end='')
-        for i in all_items.keys():
-            for v in e_values:
-                val = lookup_fn(t, i, v)
-                if val is None:
-                    print(",", end='')
-                else:
-                    print(",", val, sep='', end='')
-        print()
+            header.append(i + " [" + v + "]")
+    wr.writerow(header)
+    # then pivot all the values
+    n_values = len(e_values)
+    cur_ts = None
+    row = None
+    ri = cur.execute(query + "\nORDER BY ts", params)
+    while True:
+        chunk = ri.fetchmany(G_EXPORT_FETCH_SIZE)
+        if not chunk:
+            break
+        for v in chunk:
+            if v[1] != cur_ts:
+                if row is not None:
+                    wr.writerow(row)
+                cur_ts = v[1]
+                row = [''] * (1 + n_values*len(items))
+                row[0] = str(db_ts_to_datetime(cur_ts))
+            pos = 1 + items[v[0]]*n_values
+            row[pos:pos+n_values] = v[2:2+n_values]
+    if row is not None:
+        wr.writerow(row)
+    return None
+
+# writes the extraction as a binary columnar file (see G_EXPORT_MAGIC):
+# one array per column (item index, ts and the values) plus the list
+# of items in the header; rows are sorted by item and ts and columns
+# are filled in place via memory maps, G_EXPORT_FETCH_SIZE rows at a time
+def do_extract_binary(fname, search_nm, e_values, *, tags=[], n_days=G_N_DAYS_HIST):
+    db = db_ro()
+    db_set_cancel(db, None)
+    query, params = build_extract_query(search_nm, e_values, tags=tags, tag_ids=db_tag_ids(db, tags), n_days=n_days, fts=db_has_table(db, G_DB_ITEMS_FTS), int_ts=db_int_ts(db))
+    cur = db.cursor()
+    ri = cur.execute("SELECT name FROM (" + query + ") GROUP BY name ORDER BY MIN(item_id)", params)
+    items = {}
+    for v in ri:
+        items[v[0]] = len(items)
+    n_rows = cur.execute("SELECT COUNT(0) FROM (" + query + ")", params).fetchone()[0]
+    col_dtypes = {'item': np.dtype('<i4'), 'ts': np.dtype('<M8[s]')}
+    for v in e_values:
+        col_dtypes[v] = np.dtype('<i8') if v in G_HIST_INT_VALUES else np.dtype('<f8')
+    # the header has to be written first, but it
+    # depends on the offsets of all the columns
+    def align(x):
+        return (x + G_EXPORT_ALIGN - 1)//G_EXPORT_ALIGN*G_EXPORT_ALIGN
+    columns = {}
+    hdr_len = 0
+    while True:
+        offset = align(len(G_EXPORT_MAGIC) + 8 + hdr_len)
+        for k, d in col_dtypes.items():
+            columns[k] = {'dtype': d.str, 'offset': offset}
+            offset = align(offset + d.itemsize*n_rows)
+        hdr = json.dumps({'items': list(items.keys()), 'n_rows': n_rows, 'columns': columns}).encode('utf-8')
+        if len(hdr) <= hdr_len:
+            break
+        hdr_len = len(hdr)
+    with open(fname, 'wb') as f:
+        f.write(G_EXPORT_MAGIC)
+        f.write(len(hdr).to_bytes(8, 'little'))
+        f.write(hdr)
+        f.truncate(offset)
+    if n_rows == 0:
+        return None
+    cols = {k: np.memmap(fname, dtype=d, mode='r+', offset=columns[k]['offset'], shape=(n_rows,)) for k, d in col_dtypes.items()}
+    ts_epoch = {}
+    pos = 0
+    ri = cur.execute(query + "\nORDER BY item_id, ts", params)
+    while True:
+        chunk = ri.fetchmany(G_EXPORT_FETCH_SIZE)
+        if not chunk:
+            break
+        end = pos + len(chunk)
+        c_cols = list(zip(*chunk))
+        cols['item'][pos:end] = [items[x] for x in c_cols[0]]
+        for x in c_cols[1]:
+            if x not in ts_epoch:
+                ts_epoch[x] = db_ts_to_epoch(x)
+        cols['ts'][pos:end] = np.array([ts_epoch[x] for x in c_cols[1]], dtype=np.int64).astype('<M8[s]')
+        for i in range(len(e_values)):
+            cols[e_values[i]][pos:end] = c_cols[2+i]
+        pos = end
+    for c in cols.values():
+        c.flush()
+    return None
+
+# loads a file written by do_extract_binary, returns (items, columns)
+# where columns are read-only memory mapped arrays, nothing is parsed
+# but the header; columns['item'] indexes items
+def load_hist_export(fname):
+    with open(fname, 'rb') as f:
+        if f.read(len(G_EXPORT_MAGIC)) != G_EXPORT_MAGIC:
+            raise ValueError(f'File {fname} is not a wfmarkethist binary export')
+        hdr_len = int.from_bytes(f.read(8), 'little')
+        hdr = json.loads(f.read(hdr_len).decode('utf-8'))
+    columns = {}
+    for k, c in hdr['columns'].items():
+        if hdr['n_rows'] == 0:
+            columns[k] = np.empty(0, dtype=np.dtype(c['dtype']))
+        else:
+            columns[k] = np.memmap(fname, dtype=np.dtype(c['dtype']), mode='r', offset=c['offset'], shape=(hdr['n_rows'],))
+    return hdr['items'], columns
+
+# runs the GUI queries on a worker thread: requests are debounced,
+# superseded ones are dropped (or interrupted if already running) and
+# the results are handed back to the Tk main thread via 'after'
+class QueryScheduler:
+    def __init__(self, widget, delay_ms=G_SEARCH_DEBOUNCE_MS):
+        self.widget = widget
+        self.delay_ms = delay_ms
+        self.after_id = None
+        self.gen = 0
+        self.n_pending = 0
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    # query_fn(cancel_fn) runs on the worker, done_fn(result) on the
+    # main thread, only if no other request has been submitted since
+    def submit(self, query_fn, done_fn):
+        self.cancel()
+        gen = self.gen
+        self.after_id = self.widget.after(self.delay_ms, lambda: self.dispatch(gen, query_fn, done_fn))
+
+    # drops any scheduled or running request
+    def cancel(self):
+        self.gen += 1
+        if self.after_id is not None:
+            self.widget.after_cancel(self.after_id)
+            self.after_id = None
+
+    def is_stale(self, gen):
+        return gen != self.gen
+
+    def dispatch(self, gen, query_fn, done_fn):
+        self.after_id = None
+        self.requests.put((gen, query_fn, done_fn))
+        self.n_pending += 1
+        if self.n_pending == 1:
+            self.widget.after(G_SEARCH_POLL_MS, self.poll)
+
+    # worker thread
+    def run(self):
+        while True:
+            gen, query_fn, done_fn = self.requests.get()
+            rv = None
+            err = None
+            if not self.is_stale(gen):
+                try:
+                    rv = query_fn(lambda: self.is_stale(gen))
+                except Exception as e:
+                    err = e
+            self.results.put((gen, rv, err, done_fn))
+
+    # main thread
+    def poll(self):
+        while not self.results.empty():
+            gen, rv, err, done_fn = self.results.get()
+            self.n_pending -= 1
+            if self.is_stale(gen):
+                continue
+            if err is not None:
+                print("Error while querying (", err, ")")
+                continue
+            done_fn(rv)
+        if self.n_pending > 0:
+            self.widget.after(G_SEARCH_POLL_MS, self.poll)
+
+# Largest-Triangle-Three-Buckets (Steinarsson): returns the indices of
+# n_out points of the (x, y) line, the first and the last one plus, for
+# each bucket in between, the point making the largest triangle with
+# the one picked in the previous bucket and the mean of the next one;
+# NaNs are never picked nor averaged, only the other points are bucketed
+def lttb_indices(x, y, n_out):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    if not valid.all():
+        idx = np.flatnonzero(valid)
+        return idx[lttb_indices(x[idx], y[idx], n_out)]
+    n = len(x)
+    if (n_out >= n) or (n_out < 3):
+        return np.arange(n)
+    # n_out-2 buckets over the points between the first and the last
+    edges = np.linspace(1, n-1, n_out-1).astype(np.int64)
+    counts = np.diff(edges)
+    x_sum = np.concatenate(([0.0], np.cumsum(x)))
+    y_sum = np.concatenate(([0.0], np.cumsum(y)))
+    # the mean of the next bucket, which is the last point for the last one
+    x_next = np.append((x_sum[edges[1:]] - x_sum[edges[:-1]])/counts, x[-1])[1:].tolist()
+    y_next = np.append((y_sum[edges[1:]] - y_sum[edges[:-1]])/counts, y[-1])[1:].tolist()
+    rv = np.empty(n_out, dtype=np.int64)
+    rv[0] = 0
+    rv[-1] = n-1
+    a = 0
+    for i, (lo, hi) in enumerate(zip(edges[:-1].tolist(), edges[1:].tolist())):
+        a_x = x[a]
+        a_y = y[a]
+        area = np.abs((a_x - x_next[i])*(y[lo:hi] - a_y) - (a_x - x[lo:hi])*(y_next[i] - a_y))
+        a = lo + int(np.argmax(area))
+        rv[i+1] = a
+    return rv
+
+# mean of y over n_out buckets of the same width splitting [x0, x1];
+# returns the bucket centres, the means and the bar width; NaNs are
+# not counted and empty buckets are dropped. If there are no more
+# points than buckets they are returned as they are, with the width
+# of a day
+def bucket_mean(x, y, n_out, x0, x1):
+    if (len(x) <= n_out) or (n_out < 1) or (x1 <= x0):
+        return x, y, 0.8
+    b_w = (x1 - x0)/n_out
+    valid = ~np.isnan(y)
+    idx = np.clip(((x[valid] - x0)/b_w).astype(np.int64), 0, n_out-1)
+    counts = np.bincount(idx, minlength=n_out)
+    sums = np.bincount(idx, weights=y[valid], minlength=n_out)
+    mask = counts > 0
+    centres = x0 + (np.arange(n_out) + 0.5)*b_w
+    return centres[mask], sums[mask]/counts[mask], b_w*0.8
 
 class HistWin(Frame):
     def __init__(self, master=None):
         super().__init__(master)
         self.graph = None
         self.canvas = None
+        self.scheduler = QueryScheduler(self)
         self.reset_data()
         self.create_widgets()
 
     def reset_data(self):
         self.my_item_data = ""
         self.my_x_data = []
+        self.my_x_num = np.empty(0)
         self.my_y1_data = {'min':[], 'avg':[], 'max':[]}
         self.my_y2_data = []
 
     def search_changed(self, *args):
         v = self.search_val.get()
         if len(v) <= 0:
+            self.scheduler.cancel()
             self.other_items_val.set("")
             self.reset_data()
             self.update_graph()
             return None
-        ev = do_extract([v], ['volume', 'min', 'avg', 'max'], wildcard_ws=True, n_days=G_N_DAYS_HIST)
+        self.scheduler.submit(lambda cancel_fn: do_extract_columns([v], ['volume', 'min', 'avg', 'max'], wildcard_ws=True, n_days=G_N_DAYS_HIST, cancel_fn=cancel_fn), self.search_done)
+
+    def search_done(self, ev):
+        ts, items, values = ev
         # get the first item in alphabetical order
-        all_items = {}
-        for k, v in ev.items():
-            for i in v.keys():
-                all_items[i] = 0
-        sorted_items = list(all_items.keys())
-        sorted_items.sort()
+        sorted_items = sorted(items)
         if not sorted_items:
             self.other_items_val.set("<no suggestions available>")
             self.reset_data()
@@ -464,58 +1695,122 @@ class HistWin(Frame):
         self.other_items_val.set(', '.join(sorted_items)[:2048])
         # extract the time keys only where we have
         # our item
-        time_keys = []
-        for k, v in ev.items():
-            if si in v:
-                time_keys.append(k)
-        time_keys.sort()
+        k = items.index(si)
+        mask = ~np.isnan(values['volume'][k])
         self.reset_data()
         self.my_item_data = si
-        for k in time_keys:
-            v = ev[k]
-            self.my_x_data.append(k)
-            self.my_y1_data['min'].append(v[si]['min'])
-            self.my_y1_data['avg'].append(v[si]['avg'])
-            self.my_y1_data['max'].append(v[si]['max'])
-            self.my_y2_data.append(v[si]['volume'])
+        self.my_x_data = ts[mask]
+        self.my_x_num = mdates.date2num(self.my_x_data)
+        self.my_y1_data['min'] = values['min'][k][mask]
+        self.my_y1_data['avg'] = values['avg'][k][mask]
+        self.my_y1_data['max'] = values['max'][k][mask]
+        self.my_y2_data = values['volume'][k][mask]
         self.update_graph()
 
+    # the axes and their artists are created once,
+    # update_graph then only swaps the data in them
+    def create_plot(self):
+        self.in_update = False
+        self.sp = self.graph.add_subplot(111)
+        self.sp.xaxis_date()
+        self.sp.set_ylabel('Price', color="red")
+        self.avg_line = self.sp.axhline(y=0, color=[0.75, 0.5, 0.5], linestyle=':')
+        self.lines = {}
+        for k, c in (('min', [1, 0, 0]), ('avg', [1, 0.5, 0.5]), ('max', [1, 0.75, 0.75])):
+            self.lines[k], = self.sp.plot([], [], color=c)
+        self.sp2 = self.sp.twinx()
+        self.sp2.set_ylabel('Volume', color="blue")
+        self.bars = PolyCollection([], facecolors=[[0, 0, 1, 0.3]], edgecolors='none')
+        self.sp2.add_collection(self.bars, autolim=False)
+        self.bars_max = 0.0
+        # zooming and panning with the toolbar move the x limits
+        # of either axis, the callbacks of both are run as they
+        # share x, hence one is enough
+        self.sp.callbacks.connect('xlim_changed', self.view_changed)
+
+    # downsamples the points within the x limits to the width of
+    # the axes in pixels and swaps them in the lines and bars
+    def set_plot_data(self):
+        x0, x1 = self.sp.get_xlim()
+        px_w = self.sp.bbox.width
+        x = self.my_x_num
+        # keep a point past each side so the lines reach the edges
+        lo = max(int(np.searchsorted(x, x0)) - 1, 0)
+        hi = int(np.searchsorted(x, x1, side='right')) + 1
+        for k, l in self.lines.items():
+            y = self.my_y1_data[k][lo:hi]
+            idx = lttb_indices(x[lo:hi], y, int(px_w/G_HIST_PX_PER_POINT))
+            l.set_data(x[lo:hi][idx], y[idx])
+        lo = int(np.searchsorted(x, x0))
+        hi = int(np.searchsorted(x, x1, side='right'))
+        b_x, b_h, b_w = bucket_mean(x[lo:hi], self.my_y2_data[lo:hi], int(px_w/G_HIST_PX_PER_BAR), x0, x1)
+        verts = np.zeros((len(b_x), 4, 2))
+        verts[:, :2, 0] = (b_x - b_w/2)[:, None]
+        verts[:, 2:, 0] = (b_x + b_w/2)[:, None]
+        verts[:, 1:3, 1] = np.asarray(b_h)[:, None]
+        self.bars.set_verts(verts)
+        self.bars_max = float(np.max(b_h)) if len(b_h) else 0.0
+
+    def view_changed(self, *args):
+        if self.in_update or (self.canvas is None) or (len(self.my_x_num) <= 0):
+            return None
+        self.in_update = True
+        self.set_plot_data()
+        self.in_update = False
+        self.canvas.draw_idle()
+
     def update_graph(self, w=0, h=0):
+        if not self.graph:
+            self.graph = Figure(dpi=100)
+            self.create_plot()
+        if self.canvas is None:
+            self.canvas = FigureCanvasTkAgg(self.graph, master=self)
+            self.toolbar = NavigationToolbar2Tk(self.canvas, self, pack_toolbar=False)
+            self.canvas.mpl_connect('resize_event', self.view_changed)
+            self.place_graph(w, h)
+        has_data = len(self.my_x_num) > 0
+        self.sp.set_visible(has_data)
+        self.sp2.set_visible(has_data)
+        if has_data:
+            self.in_update = True
+            self.sp.set_title(self.my_item_data)
+            self.avg_line.set_ydata([self.my_y1_data['avg'][-1]]*2)
+            self.sp.set_xlim(self.my_x_num.min(), self.my_x_num.max())
+            self.set_plot_data()
+            self.sp.set_autoscaley_on(True)
+            self.sp.relim()
+            self.sp.autoscale_view(scalex=False)
+            self.sp.set_ylim(ymin=0)
+            self.sp2.set_ylim(0, max(self.bars_max*1.05, 1.0))
+            for l in self.sp.get_xticklabels():
+                l.set_rotation(25)
+                l.set_horizontalalignment('right')
+            self.in_update = False
+        # 'home' on the toolbar goes back to the whole item
+        self.toolbar.update()
+        # no blitting: the limits and ticks change along with the
+        # data, so there's no background left to reuse
+        self.canvas.draw_idle()
+
+    # the Tk canvas resizes the figure and redraws it
+    # on its own when its geometry changes
+    def place_graph(self, w=0, h=0):
         if (w == 0) or (h == 0):
             w = self.master.winfo_width()
             h = self.master.winfo_height()
-        dpi = 100
         g_w = (w-20)
-        g_h = (h-self.graph_start_y-35)
-        if not self.graph:
-            self.graph = Figure(figsize=(g_w/dpi, g_h/dpi), dpi=100)
-        self.graph.clear()
-        if self.my_x_data:
-            sp = self.graph.add_subplot(111)
-            sp.set_ylabel('Price', color="red")
-            sp.set_title(self.my_item_data)
-            sp.axhline(y=self.my_y1_data['avg'][-1], color=[0.75, 0.5, 0.5], linestyle=':')
-            sp.plot(self.my_x_data, self.my_y1_data['min'], color=[1, 0, 0])
-            sp.plot(self.my_x_data, self.my_y1_data['avg'], color=[1, 0.5, 0.5])
-            sp.plot(self.my_x_data, self.my_y1_data['max'], color=[1, 0.75, 0.75])
-            sp2 = sp.twinx()
-            sp2.bar(self.my_x_data, self.my_y2_data, color=[0, 0, 1, 0.3])
-            sp2.set_ylabel('Volume', color="blue")
-            sp.set_xlim(min(self.my_x_data), max(self.my_x_data))
-            sp.set_ylim(ymin=0)
-            for l in sp.get_xticklabels():
-                l.set_rotation(25)
-                l.set_horizontalalignment('right')
-        if self.canvas is None:
-            self.canvas = FigureCanvasTkAgg(self.graph, master=self)
-        self.canvas.draw()
+        g_h = (h-self.graph_start_y-35-G_HIST_TOOLBAR_H)
         self.canvas.get_tk_widget().place(x=10, y=self.graph_start_y, width=g_w, height=g_h)
+        self.toolbar.place(x=10, y=self.graph_start_y+g_h, width=g_w, height=G_HIST_TOOLBAR_H)
 
     def do_resize(self, w, h):
         oc_w = w - self.other_items.winfo_x() - 20
         self.other_items.place(width=oc_w)
         self.config(width=w, height=h)
-        self.update_graph(w, h)
+        if self.canvas is None:
+            self.update_graph(w, h)
+        else:
+            self.place_graph(w, h)
         self.config(width=w, height=h)
 
     def create_widgets(self):
@@ -536,57 +1831,119 @@ class HistWin(Frame):
         y_plc += 24+10
         self.graph_start_y = y_plc
 
-# values has to be a list of dictionaries of the form {'id':<string>, 'value':<float>}
-def treemap_plot(values, tl = {'x':0.0, 'y':0.0}, br = {'x':1.0, 'y':1.0}, split_x=True):
-    if 0 == len(values):
-        return []
-    if 1 == len(values):
-        return [{'id':values[0]['id'], 'tl':tl, 'br':br, 'value':values[0]['value']}]
-    else:
-        # recursive step, splitting the list in 2
-        split_s = len(values) // 2
-        v_left = values[:split_s]
-        v_right = values[split_s:]
-        v_left_sum = sum([x['value'] for x in v_left])
-        v_right_sum = sum([x['value'] for x in v_right])
-        w_left = v_left_sum/(v_left_sum + v_right_sum)
-        n_br = {}
-        if split_x:
-            x_sz = br['x'] - tl['x']
-            new_x = tl['x'] + x_sz*w_left
-            n_br['x'] = new_x
-            n_br['y'] = br['y']
-        else:
-            y_sz = br['y'] - tl['y']
-            new_y = tl['y'] + y_sz*w_left
-            n_br['x'] = br['x']
-            n_br['y'] = new_y
-        next_split_x = not split_x
-        if split_x:
-            rv_left = treemap_plot(v_left, tl, n_br, next_split_x)
-            rv_right = treemap_plot(v_right, {'x':n_br['x'], 'y':tl['y']}, br, next_split_x)
+# squarified treemap (Bruls, Huizing, van Wijk) of values within the
+# rectangle (x, y, w, h); returns a (n, 4) array of x0, y0, x1, y1 in
+# the same order as values. Rows of rectangles are laid out along the
+# shorter side, growing each row while its worst aspect ratio improves;
+# values <= 0 get empty rectangles and if none is > 0 all are equal
+def treemap_layout(values, x=0.0, y=0.0, w=1.0, h=1.0):
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    rv = np.zeros((n, 4))
+    if n == 0:
+        return rv
+    v = np.where(np.isfinite(values) & (values > 0.0), values, 0.0)
+    if v.sum() <= 0.0:
+        v = np.ones(n)
+    order = np.argsort(-v, kind='stable')
+    n_pos = int(np.count_nonzero(v))
+    # areas sorted descending, scaled to the rectangle
+    a = v[order[:n_pos]]*(w*h/v.sum())
+    a_sum = np.concatenate(([0.0], np.cumsum(a)))
+    # plain floats are way faster than numpy
+    # scalars in the loop below
+    a_l = a.tolist()
+    a_sum_l = a_sum.tolist()
+    # empty rectangles sit in the bottom right corner
+    rv[order[n_pos:]] = (x + w, y + h, x + w, y + h)
+    # rows as (first, last+1, area, x, y, length, thickness, vertical),
+    # the rectangles are then placed all at once
+    rows = []
+    i = 0
+    while i < n_pos:
+        short2 = min(w, h)**2
+        a_max = a_l[i]
+        a_base = a_sum_l[i]
+        j = i + 1
+        row_sum = a_max
+        worst = max(short2/row_sum, row_sum/short2)
+        while j < n_pos:
+            s = a_sum_l[j+1] - a_base
+            # a[i] and a[j] are the largest and smallest in the row
+            cur = max(short2*a_max/(s*s), s*s/(short2*a_l[j]))
+            if cur > worst:
+                break
+            worst = cur
+            row_sum = s
+            j += 1
+        # the last row takes all the space left, so
+        # that rounding doesn't leave any gap
+        if w >= h:
+            # column on the left
+            thick = w if j == n_pos else row_sum/h
+            rows.append((i, j, row_sum, x, y, h, thick, True))
+            x += thick
+            w -= thick
         else:
-            rv_left = treemap_plot(v_left, tl, n_br, next_split_x)
-            rv_right = treemap_plot(v_right, {'x':tl['x'], 'y':n_br['y']}, br, next_split_x)
-        return rv_left + rv_right
-
-# draw a treemap (tm) obtained via treemap_plot and an axis (ax) via
-# matplotlib figure <Figure>.add_subplot(...)
-def treemap_draw(tm, ax, *, color_fn=None):
-    #draw a fake line, fully transparent
-    ax.plot([0, 1], [0, 1], color=[1, 1, 1, 0])
+            # row at the bottom
+            thick = h if j == n_pos else row_sum/w
+            rows.append((i, j, row_sum, x, y, w, thick, False))
+            y += thick
+            h -= thick
+        i = j
+    r_first, _, r_sum, r_x, r_y, r_len, r_thick, r_vert = [np.repeat(np.array(c), [r[1]-r[0] for r in rows]) for c in zip(*rows)]
+    # offsets of each rectangle along its row
+    f0 = (a_sum[:-1] - a_sum[r_first])/r_sum
+    f1 = (a_sum[1:] - a_sum[r_first])/r_sum
+    rv[order[:n_pos], 0] = np.where(r_vert, r_x, r_x + r_len*f0)
+    rv[order[:n_pos], 1] = np.where(r_vert, r_y + r_len*f0, r_y)
+    rv[order[:n_pos], 2] = np.where(r_vert, r_x + r_thick, r_x + r_len*f1)
+    rv[order[:n_pos], 3] = np.where(r_vert, r_y + r_len*f1, r_y + r_thick)
+    return rv
+
+# values has to be a list of dictionaries of the form {'id':<string>, 'value':<float>}
+# aspect is the width/height ratio the unit square is displayed with, the
+# rectangles are squarified accordingly
+def treemap_plot(values, tl = {'x':0.0, 'y':0.0}, br = {'x':1.0, 'y':1.0}, aspect=1.0):
+    w = br['x'] - tl['x']
+    h = br['y'] - tl['y']
+    # lay out in display proportions, then scale back
+    rects = treemap_layout([x['value'] for x in values], 0.0, 0.0, w*aspect, h)
+    rects[:, [0, 2]] = rects[:, [0, 2]]/aspect + tl['x']
+    rects[:, [1, 3]] += tl['y']
+    rv = []
+    for v, r in zip(values, rects.tolist()):
+        rv.append({'id':v['id'], 'tl':{'x':r[0], 'y':r[1]}, 'br':{'x':r[2], 'y':r[3]}, 'value':v['value']})
+    return rv
+
+# draw a treemap laid out by treemap_layout (rects) within the unit
+# square on an axis (ax) via matplotlib figure <Figure>.add_subplot(...);
+# all the rectangles are a single collection, face_colors being a (n, 3)
+# array, and only the labels fitting their rectangle are drawn
+def treemap_draw(rects, labels, ax, *, face_colors=None, font_size=10):
+    ax.set_xlim(0.0, 1.0)
+    ax.set_ylim(0.0, 1.0)
     ax.set_axis_off()
-    # for consistent colours
-    if not color_fn:
-        random.seed(a="123")
-    for el in tm:
-        r_color = (random.random(), random.random(), random.random()) if not color_fn else color_fn(el['value'])
-        r = Rectangle((el['tl']['x'], el['tl']['y']), el['br']['x']-el['tl']['x'], el['br']['y']-el['tl']['y'], facecolor=r_color)
-        ax.add_patch(r)
-        rx, ry = r.get_xy()
-        cx = rx + r.get_width()/2.0
-        cy = ry + r.get_height()/2.0
-        ax.annotate(el['id'], (cx, cy), ha='center', va='center')
+    if face_colors is None:
+        # for consistent colours
+        face_colors = np.random.default_rng(123).random((len(rects), 3))
+    verts = np.stack([rects[:, [0, 1]], rects[:, [0, 3]], rects[:, [2, 3]], rects[:, [2, 1]]], axis=1)
+    ax.add_collection(PolyCollection(verts, facecolors=face_colors, edgecolors='none'))
+    # rough size of the labels in pixels, to cull the
+    # ones which would overflow their rectangle
+    bb = ax.get_window_extent()
+    px_w = (rects[:, 2] - rects[:, 0])*bb.width
+    px_h = (rects[:, 3] - rects[:, 1])*bb.height
+    font_px = font_size*ax.figure.dpi/72.0
+    lbl_w = np.array([len(x) for x in labels])*font_px*0.6
+    # labels not fitting on one line can
+    # still fit with one word per line
+    wrp_w = np.array([max(len(y) for y in x.split()) if x.strip() else 0 for x in labels])*font_px*0.6
+    wrp_h = np.array([len(x.split()) for x in labels])*font_px*1.2
+    fit = (px_w >= lbl_w) & (px_h >= font_px*1.2)
+    fit_wrp = ~fit & (px_w >= wrp_w) & (px_h >= wrp_h)
+    for i in np.flatnonzero(fit | fit_wrp):
+        ax.text((rects[i, 0] + rects[i, 2])/2.0, (rects[i, 1] + rects[i, 3])/2.0, '\n'.join(labels[i].split()) if fit_wrp[i] else labels[i], ha='center', va='center', fontsize=font_size)
 
 class TagsPicker(Frame):
     def __init__(self, master, treemap):
@@ -642,6 +1999,7 @@ class TreeMapWin(Frame):
         super().__init__(master)
         self.graph = None
         self.canvas = None
+        self.scheduler = QueryScheduler(self)
         self.tags = []
         self.tags_andor = True
         self.min_value = 0.0
@@ -651,18 +2009,32 @@ class TreeMapWin(Frame):
         self.reset_data()
         self.create_widgets()
 
-    def get_color(self, cur_value):
-        sf = 0.5
+    # colors of the values, linear between min_color and max_color
+    def get_colors(self, values):
+        sf = np.full(len(values), 0.5)
         if (self.max_value - self.min_value) != 0.0:
-            sf = 1.0 - (self.max_value - cur_value)/(self.max_value - self.min_value)
-        r_sf = []
-        for i in range(3):
-            r_sf.append(self.min_color[i] + (self.max_color[i] - self.min_color[i])*sf)
-        return (r_sf[0], r_sf[1], r_sf[2])
+            sf = 1.0 - (self.max_value - values)/(self.max_value - self.min_value)
+        return np.asarray(self.min_color) + np.outer(sf, np.subtract(self.max_color, self.min_color))
 
     def reset_data(self):
         # this should be in the form of [{'id':'val1', 'value':1.0}, {'id':'val2', 'value':0.5}, {'id':'val3', 'value':0.4}]
         self.my_tm_data = []
+        # rows of the last summary, so that the graph type can
+        # be changed without querying again
+        self.my_tm_rows = []
+        # layouts of the current rows by graph type, only
+        # for the aspect the treemap is displayed with
+        self.my_tm_layouts = {}
+        self.my_tm_aspect = None
+
+    def set_tm_data(self):
+        self.my_tm_data = []
+        for e in self.my_tm_rows:
+            self.my_tm_data.append({'id':e[0], 'value':(e[1] if self.graph_type.get() == "Price" else e[2] if self.graph_type.get() == "Volume" else e[3])})
+
+    def graph_type_changed(self, *args):
+        self.set_tm_data()
+        self.update_graph()
 
     def btn_tags(self):
         root = Toplevel()
@@ -671,12 +2043,17 @@ class TreeMapWin(Frame):
     def search_changed(self, *args):
         v = self.search_val.get()
         if len(v.strip()) < 3 and not self.tags:
+            self.scheduler.cancel()
             self.other_items_val.set("")
             self.reset_data()
             self.update_graph()
             return None
         items = [x for x in v.split(',') if len(x) > 0]
-        ev = do_summary(min_volume=0, min_price=0, search_nm=items, search_tags=self.tags, tags_andor=self.tags_andor, exclude_sets=False)
+        tags = self.tags
+        tags_andor = self.tags_andor
+        self.scheduler.submit(lambda cancel_fn: do_summary(min_volume=0, min_price=0, search_nm=items, search_tags=tags, tags_andor=tags_andor, exclude_sets=False, cancel_fn=cancel_fn), self.search_done)
+
+    def search_done(self, ev):
         # get the first item in alphabetical order
         ev.sort()
         if not ev:
@@ -685,9 +2062,12 @@ class TreeMapWin(Frame):
             self.update_graph()
             return None
         self.other_items_val.set(', '.join([x[0] for x in ev])[:2048])
-        self.reset_data()
-        for e in ev:
-            self.my_tm_data.append({'id':e[0], 'value':(e[1] if self.graph_type.get() == "Price" else e[2] if self.graph_type.get() == "Volume" else e[3])})
+        # the layouts still hold if the
+        # same items have been found
+        if ev != self.my_tm_rows:
+            self.reset_data()
+            self.my_tm_rows = ev
+        self.set_tm_data()
         self.update_graph()
 
     def update_graph(self, w=0, h=0):
@@ -702,10 +2082,19 @@ class TreeMapWin(Frame):
         self.graph.clear()
         if self.my_tm_data:
             ax = self.graph.add_subplot(111)
-            my_vals = [x['value'] for x in self.my_tm_data]
-            self.min_value = min(my_vals)
-            self.max_value = max(my_vals)
-            treemap_draw(treemap_plot(self.my_tm_data), ax, color_fn=self.get_color)
+            my_vals = np.array([x['value'] for x in self.my_tm_data], dtype=np.float64)
+            self.min_value = my_vals.min()
+            self.max_value = my_vals.max()
+            # squarify in the proportions the axis is displayed with
+            pos = ax.get_position()
+            aspect = float((pos.width*g_w)/(pos.height*g_h))
+            if round(aspect, 3) != self.my_tm_aspect:
+                self.my_tm_layouts = {}
+                self.my_tm_aspect = round(aspect, 3)
+            k = self.graph_type.get()
+            if k not in self.my_tm_layouts:
+                self.my_tm_layouts[k] = treemap_layout(my_vals, 0.0, 0.0, aspect, 1.0)/[aspect, 1.0, aspect, 1.0]
+            treemap_draw(self.my_tm_layouts[k], [x['id'] for x in self.my_tm_data], ax, face_colors=self.get_colors(my_vals))
             if self.tags:
                 ax.set_title("Tags: " + ', '.join(self.tags))
             colmap = cm.ScalarMappable(cmap=colors.LinearSegmentedColormap.from_list("", [self.min_color, self.max_color]))
@@ -747,7 +2136,7 @@ class TreeMapWin(Frame):
         # values for the volume weight in the results
         self.graph_type = StringVar()
         self.graph_type.set("Price")
-        self.graph_type.trace_add("write", self.search_changed)
+        self.graph_type.trace_add("write", self.graph_type_changed)
         self.gtype_menu = OptionMenu(self, self.graph_type, "Price", "Volume", "Price Chng %")
         self.gtype_menu.place(y=y_plc, width=128, height=24)
         # button to display pop-up to set tags
@@ -811,7 +2200,7 @@ def display_graphs():
 
 def main():
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "gueshx", ["show-tags", "tags=", "force-tags", "update-detail", "update-all", "graphs", "update", "extract", "summary", "summary-days=", "summary-any", "search", "help", "values=", "missing", "no-hist-limit", "x-all", "throttle="])
+        opts, args = getopt.getopt(sys.argv[1:], "gueshx", ["show-tags", "tags=", "force-tags", "update-detail", "update-all", "graphs", "update", "extract", "summary", "summary-days=", "summary-any", "search", "help", "values=", "missing", "no-hist-limit", "x-all", "throttle=", "workers=", "api-url=", "batch-size=", "explain", "output=", "gzip", "export-format=", "cache-dir=", "cache-size=", "cache-compress", "replay", "resume", "adaptive", "metrics-out="])
     except getopt.GetoptError as err:
         print(err)
         sys.exit(-1)
@@ -825,6 +2214,15 @@ def main():
     force_tags = False
     tags = []
     do_summary_sets = False
+    explain = False
+    output_file = None
+    output_gzip = False
+    export_format = 'csv'
+    cache_dir = None
+    cache_compress = False
+    cache_replay = False
+    resume = False
+    metrics_file = None
     for o, a in opts:
         if o in ("-g", "--graphs"):
             exec_mode = 'g'
@@ -868,6 +2266,18 @@ Usage: (options) item1, item2, ...
 --update-detail Print individual item timeseries details when updating.
                 By default this is off.
 
+--resume        Carries on the last update (i.e. after it has been interrupted)
+                with the items not done yet, including the ones failed; items
+                failing are retried a few times with exponential backoff
+                within the same update too
+
+--metrics-out f Writes a JSON report of the update to file f: percentiles of
+                the time spent per item and per phase (requests, parsing,
+                planning, DB inserts and summary), bytes downloaded, rows
+                inserted per second and the time spent throttling or
+                backing off before retries (in worker-seconds, i.e. summed
+                over the workers, and as a share of workers x wall time)
+
 --force-tags    Force querying for items metadata even if already stored (it
                 should rarely change)
 
@@ -887,6 +2297,17 @@ Usage: (options) item1, item2, ...
                 - m_avg
                 Specifying any value using this option implies option '-e'
 
+--output f      Writes the extracted data to file f rather than to the
+                standard output
+
+--gzip          Compresses the extracted data with gzip; implied when the
+                file name specified with '--output' ends with '.gz'
+
+--export-format Format of the extracted data, either 'csv' (default) or 'bin',
+                a compact columnar binary file which can be memory mapped
+                (see 'load_hist_export'); 'bin' requires '--output'
+                Specifying any value using this option implies option '-e'
+
 --tags t1,...   Specify which tags to be extracted; tags are dynamic; to show
                 what tags are available, please run with '--show-tags'
                 Setting this option doesn't imply not '-e' nor '-x'
@@ -912,11 +2333,44 @@ Usage: (options) item1, item2, ...
                 price (24 and 25 respectively)
                 Specifying any value using this option implies option '-x'
 
+--explain       Instead of printing out the results of '-e' or '-x', prints
+                the query plan and the timings of the underlying query
+
 --missing       Prints the missing names from the market (i.e. names we have in
                 local DB but not anymore in the market)
 
 --throttle t    Sets the sleep throttle when querying WarFrame Market (by default
-                0.5 s)
+                0.5 s); this is enforced across all the workers
+
+--adaptive      Adapts the request rate to how WarFrame Market responds,
+                starting from the one set by '--throttle': the rate is
+                increased while responses are fine and reduced on errors
+                (i.e. HTTP 429), honouring Retry-After, or slow responses
+
+--workers n     Number of concurrent workers fetching data from WarFrame Market
+                when updating (by default 1); the overall request rate is still
+                bound by '--throttle'
+
+--batch-size n  Number of items committed to the local SQLite database in a
+                single transaction when updating (by default 50); items already
+                up to date are skipped, unless '--force-tags' is specified
+
+--api-url url   Sets the base url of WarFrame Market API (by default
+                https://api.warframe.market), useful for testing
+
+--cache-dir d   Caches the raw responses of WarFrame Market in directory d;
+                cached responses are reused while fresh (1 hour for the
+                statistics, 1 day for the items list and 1 week for the items
+                metadata) and revalidated afterwards
+
+--cache-size mb Maximum size of the cache in MiB (by default 256); the least
+                recently used responses are evicted first
+
+--cache-compress Compresses the responses stored in the cache
+
+--replay        Serves all the requests from the cache (directory as per
+                '--cache-dir', by default wf_mkt_cache) without ever querying
+                WarFrame Market; requests not in the cache fail
 
 -h, --help      Displays this help and exit
             ''')
@@ -943,20 +2397,83 @@ Usage: (options) item1, item2, ...
             exec_mode = 'm'
             s_min_volume = 0
             s_min_price = 0
+        elif o in ("--output"):
+            output_file = a
+            if a.endswith(".gz"):
+                output_gzip = True
+        elif o in ("--export-format"):
+            exec_mode = 'e'
+            export_format = a
+            if export_format not in ('csv', 'bin'):
+                print("Invalid export format '" + a + "' specified")
+                sys.exit(-1)
+        elif o in ("--gzip"):
+            output_gzip = True
+        elif o in ("--explain"):
+            explain = True
         elif o in ("--missing"):
             exec_mode = 'i'
         elif o in ("--throttle"):
             global G_SLEEP_THROTTLE
             G_SLEEP_THROTTLE = float(a)
+        elif o in ("--adaptive"):
+            global G_ADAPTIVE
+            G_ADAPTIVE = True
+        elif o in ("--workers"):
+            global G_FETCH_WORKERS
+            G_FETCH_WORKERS = int(a)
+            if G_FETCH_WORKERS <= 0:
+                print("Invalid number of workers '" + a + "' specified, must be > 0")
+                sys.exit(-1)
+        elif o in ("--batch-size"):
+            global G_DB_BATCH_SIZE
+            G_DB_BATCH_SIZE = int(a)
+            if G_DB_BATCH_SIZE <= 0:
+                print("Invalid batch size '" + a + "' specified, must be > 0")
+                sys.exit(-1)
+        elif o in ("--api-url"):
+            global G_WFM_API_URL
+            G_WFM_API_URL = a
+        elif o in ("--cache-dir"):
+            cache_dir = a
+        elif o in ("--cache-size"):
+            global G_CACHE_MAX_SIZE
+            G_CACHE_MAX_SIZE = int(float(a)*1024*1024)
+            if G_CACHE_MAX_SIZE <= 0:
+                print("Invalid cache size '" + a + "' specified, must be > 0")
+                sys.exit(-1)
+        elif o in ("--cache-compress"):
+            cache_compress = True
+        elif o in ("--replay"):
+            cache_replay = True
+        elif o in ("--metrics-out"):
+            metrics_file = a
+        elif o in ("--resume"):
+            exec_mode = 'u'
+            resume = True
+    if cache_dir or cache_replay:
+        global G_WFM_CACHE
+        G_WFM_CACHE = WebCache(cache_dir if cache_dir else G_CACHE_DIR, G_CACHE_MAX_SIZE, cache_compress, cache_replay)
     # args should contain the list of items to extract/update
     if exec_mode == 'g':
         display_graphs()
     elif exec_mode == 'u':
-        items = get_items_list(args, get_all=update_all)
-        print("\tAdding/Updating:")
-        for i in items.keys():
-            print(i)
-        rv, rv_q, rv_subt, max_ts_interval = store_hist_data(items, force_tags)
+        # when resuming the items come from
+        # the checkpoint of the last update
+        items = get_items_list(args, get_all=update_all) if not resume else {}
+        if not resume:
+            print("\tAdding/Updating:")
+            for i in items.keys():
+                print(i)
+        try:
+            rv, rv_q, rv_subt, max_ts_interval = store_hist_data(items, force_tags, skip_current=not force_tags, resume=resume)
+        except KeyboardInterrupt:
+            print("\n\tInterrupted, run with '--resume' to carry on")
+            if metrics_file:
+                G_METRICS.write(metrics_file)
+            sys.exit(-1)
+        if metrics_file:
+            G_METRICS.write(metrics_file)
         if update_detail:
             print("\tEntries added:")
             for i in rv:
@@ -1006,14 +2523,31 @@ Usage: (options) item1, item2, ...
                 rv_stypes[i].sort()
                 print(i, "->", rv_stypes[i])
     elif exec_mode == 'e':
-        ev = do_extract(args, extract_values, tags=tags, n_days=G_N_DAYS_HIST)
-        do_extract_printout(ev, extract_values)
+        if explain:
+            do_explain(*build_extract_query(args, extract_values, tags=tags, tag_ids=db_tag_ids(db_ro(), tags), n_days=G_N_DAYS_HIST, fts=db_has_table(db_ro(), G_DB_ITEMS_FTS), int_ts=db_int_ts(db_ro())))
+            return None
+        if export_format == 'bin':
+            if not output_file:
+                print("Binary export requires an output file, please specify '--output'")
+                sys.exit(-1)
+            do_extract_binary(output_file, args, extract_values, tags=tags, n_days=G_N_DAYS_HIST)
+            return None
+        out = open_output(output_file, output_gzip)
+        try:
+            do_extract_stream(out, args, extract_values, tags=tags, n_days=G_N_DAYS_HIST)
+        finally:
+            if out is not sys.stdout:
+                out.close()
     elif exec_mode == 's':
         l_items = get_items_list(args)
         print("\tSearch:")
         for i in l_items.keys():
             print(i)
     elif exec_mode == 'm':
+        if explain:
+            rollup = db_summary_current(db_ro(), s_n_days)
+            do_explain(*build_summary_query(n_days=s_n_days, min_volume=s_min_volume, min_price=s_min_price, search_nm=args, search_tags=tags, tag_ids=db_tag_ids(db_ro(), tags), exclude_sets=not do_summary_sets, rollup=rollup, fts=db_has_table(db_ro(), G_DB_ITEMS_FTS), int_ts=db_int_ts(db_ro())))
+            return None
         rv = do_summary(n_days=s_n_days, min_volume=s_min_volume, min_price=s_min_price, search_nm=args, search_tags=tags, exclude_sets=not do_summary_sets)
         print("name,avg price,avg volume,price change %")
         for v in rv:
@@ -1024,10 +2558,7 @@ Usage: (options) item1, item2, ...
         for t in ev:
             print(t)
     elif exec_mode == 'i':
-        db = sqlite3.connect(G_DB_NAME_RO, uri=True)
-        db_setup(db)
-        lcl_nm = db_fetch_names(db, G_DB_ITEMS_NAME, [])
-        db.close()
+        lcl_nm = db_names_ids(db_ro(), G_DB_ITEMS_NAME)
         mkt_nm = get_items_list(None, True)
         print("\tMissing:")
         for n in lcl_nm:
@@ -1036,7 +2567,7 @@ Usage: (options) item1, item2, ...
 
 if __name__ == "__main__":
     # create the HTTPS pool here
-    #https_cp = urllib3.HTTPSConnectionPool('api.warframe.market')
-    #r = get_hist_stats('arcane_persistence', https_cp, True)
+    #https_cp = get_wfm_pool()
+    #r = get_hist_stats('arcane_persistence', https_cp, True, get_wfm_limiter())
     #print(r)
     main()
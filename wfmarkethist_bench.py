@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+
+import getopt
+import sys
+import os
+import json
+import time
+import datetime
+import random
+import sqlite3
+import platform
+import contextlib
+import statistics
+import functools
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+import wfmarkethist as wfm
+
+G_BENCH_REPEAT = 5
+G_BENCH_SCALES = [1000, 10000, 100000]
+G_BENCH_DAYS = 90
+G_BENCH_TAGS = 30
+G_BENCH_WORKERS = 4
+G_BENCH_WORK_DIR = "wf_bench"
+G_BENCH_SCENARIOS = ['store_hist_data', 'do_extract', 'do_summary', 'do_extract_tags', 'treemap_plot', 'treemap_draw']
+G_BENCH_SEED = 123
+# distinct synthetic payloads served by the fake api, items
+# share them so that serving stays cheap at any scale
+G_BENCH_PAYLOADS = 1000
+
+# recorded statistics payloads, either the raw responses of
+# a wfmarkethist cache (see '--cache-dir') or json files
+def load_payloads(paths):
+    rv = []
+    for p in paths:
+        if not os.path.isdir(p):
+            with open(p, 'r') as f:
+                rv.append((os.path.basename(p).split('.')[0], f.read()))
+            continue
+        cache = wfm.WebCache(p)
+        for ref in cache.refs():
+            if not ref['url'].endswith('/statistics'):
+                continue
+            try:
+                rv.append((ref['url'].split('/')[3], cache.load(ref)))
+            except OSError:
+                # evicted
+                continue
+    return rv
+
+def bench_parse(payloads, backend, repeat):
+    wfm.G_JSON_BACKEND = backend
+    rv = None
+    best = None
+    for i in range(repeat):
+        # don't let the dates cache hide the
+        # cost of parsing the timestamps
+        wfm.parse_iso_epoch.cache_clear()
+        start = time.perf_counter()
+        cur = [wfm.parse_hist_stats(data, nm) for nm, data in payloads]
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+        rv = cur
+    return best, rv
+
+def run_parse(args, repeat):
+    payloads = load_payloads(args)
+    if not payloads:
+        print("No statistics payloads found")
+        sys.exit(-1)
+    n_bytes = sum(len(x[1]) for x in payloads)
+    print("Payloads:", len(payloads), "(" + str(n_bytes) + " bytes)")
+    print("backend,total s,us/payload,MB/s,rows")
+    ref = None
+    for backend in ['json-full', 'json', 'orjson']:
+        if backend == 'orjson' and wfm.orjson is None:
+            continue
+        elapsed, rv = bench_parse(payloads, backend, repeat)
+        # all the backends have to agree
+        if ref is None:
+            ref = rv
+        elif rv != ref:
+            print("Mismatching results for backend '" + backend + "'")
+            sys.exit(-1)
+        print(backend, elapsed, elapsed*1000000.0/len(payloads), n_bytes/elapsed/1000000.0, sum(len(x[0]) for x in rv), sep=',')
+
+def synth_name(i):
+    # every 7th item is a set, as those
+    # are filtered by the summary
+    return wfm.uniform_str(f'synth item {i:06d}' + (' set' if i % 7 == 0 else ''))
+
+def synth_slug(i):
+    return f'synth_item_{i:06d}'
+
+# last closed day, as UTC midnight epoch seconds
+def synth_last_day():
+    today = datetime.datetime.now(datetime.timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(today.timestamp()) - 24*3600
+
+# deterministic daily rows of a given item, in the
+# same layout as parse_hist_stats (ts first)
+def synth_rows(i, n_days, last_day):
+    rnd = random.Random(G_BENCH_SEED + i)
+    base = rnd.uniform(5.0, 500.0)
+    rv = []
+    for d in range(n_days - 1, -1, -1):
+        avg = max(1.0, base*(1.0 + rnd.uniform(-0.2, 0.2)))
+        vol = rnd.randint(0, 200)
+        rv.append((last_day - d*24*3600, vol, int(avg*0.8), int(avg*1.2) + 1, int(avg), int(avg), avg, avg*1.01, avg, avg))
+    return rv
+
+# synthetic statistics payload as served by WarFrame Market
+@functools.lru_cache(maxsize=G_BENCH_PAYLOADS)
+def synth_payload(i, n_days, last_day):
+    rows = []
+    for r in synth_rows(i, n_days, last_day):
+        rows.append({"datetime": datetime.datetime.fromtimestamp(r[0], datetime.timezone.utc).isoformat(timespec='milliseconds'), "volume": r[1], "min_price": r[2], "max_price": r[3], "open_price": r[4], "closed_price": r[5], "avg_price": r[6], "wa_price": r[7], "median": r[8], "moving_avg": r[9], "id": synth_slug(i)})
+    return json.dumps({"payload": {"statistics_closed": {"48hours": [], "90days": rows}, "statistics_live": {"48hours": [], "90days": rows}}})
+
+def synth_tags(i, n_tags):
+    rnd = random.Random(G_BENCH_SEED*7 + i)
+    return sorted(set(f'tag{rnd.randrange(n_tags)}' for x in range(rnd.randint(1, 3))))
+
+# synthetic wf_mkt_hist.db of n_items with n_days of history each,
+# tagged with up to 3 out of n_tags tags; schema fully migrated
+def gen_db(fname, n_items, n_days=G_BENCH_DAYS, n_tags=G_BENCH_TAGS):
+    if os.path.exists(fname):
+        os.remove(fname)
+    db = sqlite3.connect(fname)
+    wfm.db_setup(db)
+    wfm.db_migrate(db)
+    cur = db.cursor()
+    cur.execute("PRAGMA synchronous=OFF")
+    cur.executemany("INSERT INTO " + wfm.G_DB_ITEMS_NAME + "(rowid, name) VALUES(?, ?)", ((i+1, synth_name(i)) for i in range(n_items)))
+    cur.executemany("INSERT INTO " + wfm.G_DB_TAGS_NAME + "(rowid, name) VALUES(?, ?)", ((j+1, f'tag{j}') for j in range(n_tags)))
+    cur.executemany("INSERT INTO " + wfm.G_DB_ITEMS_TAGS + "(item_id, tag_id) VALUES(?, ?)", ((i+1, int(t[3:])+1) for i in range(n_items) for t in synth_tags(i, n_tags)))
+    last_day = synth_last_day()
+    cur.executemany("INSERT INTO " + wfm.G_DB_ITEMS_HIST + " VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ((i+1,) + r for i in range(n_items) for r in synth_rows(i, n_days, last_day)))
+    db.commit()
+    wfm.db_sync_names_fts(db)
+    cur.execute("ANALYZE")
+    db.commit()
+    wfm.db_refresh_summary(db, list(range(1, n_items+1)))
+    db.close()
+
+# points wfmarkethist to another DB, dropping
+# the read-only connections of the old one
+def use_db(fname):
+    wfm.G_DB_NAME = fname
+    wfm.G_DB_NAME_RO = "file:" + fname + "?mode=ro"
+    db = getattr(wfm.G_DB_RO_LOCAL, 'db', None)
+    if db is not None:
+        db.close()
+        wfm.G_DB_RO_LOCAL.db = None
+
+# fake api.warframe.market serving n_items synthetic items, with
+# either synthetic statistics or recorded ones (cycled)
+class FakeApiHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        parts = self.path.split('/')
+        if self.path == '/v2/items':
+            body = srv.items_list
+        elif len(parts) == 5 and parts[4] == 'statistics' and parts[3] in srv.slugs:
+            i = srv.slugs[parts[3]]
+            body = srv.payloads[i % len(srv.payloads)] if srv.payloads else synth_payload(i % G_BENCH_PAYLOADS, srv.n_days, srv.last_day)
+        elif len(parts) == 4 and parts[3] in srv.slugs:
+            body = json.dumps({"data": {"tags": synth_tags(srv.slugs[parts[3]], srv.n_tags)}})
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        b_body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(b_body)))
+        self.end_headers()
+        self.wfile.write(b_body)
+
+def serve_fake_api(conn, n_items, n_days, n_tags, payloads):
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    srv.daemon_threads = True
+    srv.n_days = n_days
+    srv.n_tags = n_tags
+    srv.last_day = synth_last_day()
+    srv.payloads = [x[1] for x in payloads]
+    srv.slugs = {synth_slug(i): i for i in range(n_items)}
+    srv.items_list = json.dumps({"data": [{"slug": synth_slug(i), "i18n": {"en": {"name": synth_name(i)}}} for i in range(n_items)]})
+    conn.send(srv.server_address[1])
+    srv.serve_forever()
+
+# starts the fake api on a free local port, in its own process so that
+# it doesn't compete for the GIL with what is being measured; returns
+# the process and the base url
+def start_fake_api(n_items, n_days=G_BENCH_DAYS, n_tags=G_BENCH_TAGS, payloads=[]):
+    conn_r, conn_w = multiprocessing.Pipe(False)
+    proc = multiprocessing.Process(target=serve_fake_api, args=(conn_w, n_items, n_days, n_tags, payloads), daemon=True)
+    proc.start()
+    return proc, f'http://127.0.0.1:{conn_r.recv()}'
+
+# runs fn repeat times, returns the timings and the last result
+def time_runs(fn, repeat):
+    tms = []
+    rv = None
+    for i in range(repeat):
+        tm_start = time.perf_counter()
+        rv = fn()
+        tms.append(time.perf_counter() - tm_start)
+    return tms, rv
+
+def bench_result(scenario, n_items, tms, extra={}):
+    return {'scenario': scenario, 'items': n_items, 'runs': len(tms), 'best_s': min(tms), 'median_s': statistics.median(tms), 'extra': extra}
+
+def bench_store(n_items, work_dir, n_days, n_tags, payloads):
+    fname = os.path.join(work_dir, f'store_{n_items}.db')
+    if os.path.exists(fname):
+        os.remove(fname)
+    use_db(fname)
+    proc, wfm.G_WFM_API_URL = start_fake_api(n_items, n_days, n_tags, payloads)
+    try:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            items = wfm.get_items_list([], get_all=True)
+            tms, rv = time_runs(lambda: wfm.store_hist_data(items), 1)
+    finally:
+        proc.terminate()
+        proc.join()
+    m = wfm.G_METRICS.report()
+    return bench_result('store_hist_data', n_items, tms, {'rows_inserted': m['counters'].get('rows_inserted', 0), 'rates': m['rates'], 'phases_p50_s': {k: v['p50_s'] for k, v in m['phases'].items()}, 'phases_total_s': {k: v['total_s'] for k, v in m['phases'].items()}})
+
+def run_suite(scales, scenarios, work_dir, n_days, n_tags, repeat, payloads):
+    os.makedirs(work_dir, exist_ok=True)
+    # unthrottled, as fast as the fake api allows
+    wfm.G_SLEEP_THROTTLE = 0.0
+    wfm.G_WFM_CACHE = None
+    rv = []
+    for n in scales:
+        if 'store_hist_data' in scenarios:
+            print("store_hist_data", n, end='...', flush=True)
+            rv.append(bench_store(n, work_dir, n_days, n_tags, payloads))
+            print(rv[-1]['best_s'], 's')
+        if not [x for x in scenarios if x != 'store_hist_data']:
+            continue
+        # the generated DBs are kept across runs
+        fname = os.path.join(work_dir, f'synth_{n}_{n_days}_{n_tags}.db')
+        if not os.path.exists(fname):
+            print("Generating", fname, end='...', flush=True)
+            tm_start = time.perf_counter()
+            gen_db(fname, n, n_days, n_tags)
+            print(time.perf_counter() - tm_start, 's')
+        use_db(fname)
+        # ~10 items, as when searching in the Historical View
+        search_nm = [f'item {n//2:06d}'[:-1]]
+        summary = []
+        for s in scenarios:
+            if s == 'store_hist_data':
+                continue
+            print(s, n, end='...', flush=True)
+            if s == 'do_extract':
+                tms, r = time_runs(lambda: wfm.do_extract(search_nm, ['volume', 'min', 'max', 'avg']), repeat)
+                rv.append(bench_result(s, n, tms, {'entries': len(r)}))
+            elif s == 'do_summary':
+                # same as the TreeMap View with no filters
+                tms, summary = time_runs(lambda: wfm.do_summary(min_volume=0, min_price=0, exclude_sets=False), repeat)
+                rv.append(bench_result(s, n, tms, {'rows': len(summary)}))
+            elif s == 'do_extract_tags':
+                tms, r = time_runs(wfm.do_extract_tags, repeat)
+                rv.append(bench_result(s, n, tms, {'tags': len(r)}))
+            elif s == 'treemap_plot':
+                if not summary:
+                    summary = wfm.do_summary(min_volume=0, min_price=0, exclude_sets=False)
+                values = [{'id': x[0], 'value': x[1]} for x in summary]
+                tms, r = time_runs(lambda: wfm.treemap_plot(values), repeat)
+                rv.append(bench_result(s, n, tms, {'rectangles': len(r)}))
+            elif s == 'treemap_draw':
+                if not summary:
+                    summary = wfm.do_summary(min_volume=0, min_price=0, exclude_sets=False)
+                tms, r = time_runs(lambda: bench_treemap_draw(summary), repeat)
+                rv.append(bench_result(s, n, tms, {'labels': r}))
+            print(rv[-1]['best_s'], 's')
+    return rv
+
+# layout and render of the TreeMap tab, off screen
+def bench_treemap_draw(summary):
+    fig = Figure(figsize=(8, 6), dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    values = np.array([x[1] for x in summary], dtype=np.float64)
+    wfm.treemap_draw(wfm.treemap_layout(values), [x[0] for x in summary], ax)
+    fig.canvas.draw()
+    return len(ax.texts)
+
+def bench_meta(args):
+    return {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': np.__version__,
+        'json_backend': wfm.G_JSON_BACKEND,
+        'config': args,
+    }
+
+# prints the best timings of results against the ones of a
+# previous results file, matched by scenario and items
+def compare_results(results, fname):
+    with open(fname, 'r') as f:
+        base = json.load(f)
+    base_r = {(x['scenario'], x['items']): x for x in base['results']}
+    print("scenario,items,base s,new s,ratio")
+    for r in results:
+        b = base_r.get((r['scenario'], r['items']))
+        if b is None:
+            continue
+        print(r['scenario'], r['items'], b['best_s'], r['best_s'], round(r['best_s']/b['best_s'], 3) if b['best_s'] > 0.0 else '', sep=',')
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:", ["help", "repeat=", "suite", "scales=", "days=", "tags=", "scenarios=", "workers=", "work-dir=", "payloads=", "out=", "compare=", "gen-db=", "items="])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(-1)
+    repeat = G_BENCH_REPEAT
+    mode = 'p'
+    scales = G_BENCH_SCALES
+    n_days = G_BENCH_DAYS
+    n_tags = G_BENCH_TAGS
+    scenarios = G_BENCH_SCENARIOS
+    work_dir = G_BENCH_WORK_DIR
+    payloads_path = None
+    out_file = None
+    compare_file = None
+    gen_file = None
+    n_items = 1000
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            print(sys.argv[0], "Benchmarks of wfmarkethist")
+            print('''
+Usage: (options) path1, path2, ...
+
+By default times parse_hist_stats with each JSON backend over recorded
+statistics payloads; a path is either a json file or a cache directory
+populated by running wfmarkethist with '--cache-dir'
+
+-r, --repeat n  Number of runs per backend or scenario, the best one is
+                reported along with the median (by default 5)
+
+--suite         Runs the timed scenarios instead, at each scale: store_hist_data
+                against a fake local WarFrame Market api, do_extract, do_summary,
+                do_extract_tags, treemap_plot and treemap_draw (off screen)
+                against synthetic DBs
+
+--scales n,...  Number of items of each scale (by default 1000,10000,100000)
+
+--days n        Days of history of each synthetic item (by default 90)
+
+--tags n        Number of synthetic tags, each item gets up to 3 (by default 30)
+
+--scenarios s,. Runs only the given scenarios
+
+--workers n     Number of workers of store_hist_data (by default 4)
+
+--work-dir d    Directory of the DBs, generated ones are reused across runs
+                (by default wf_bench)
+
+--payloads p    Has the fake api serve the recorded statistics payloads found
+                in path p (json file or cache directory) instead of synthetic
+                ones
+
+--out f         Writes the results of the suite to JSON file f
+
+--compare f     Compares the results of the suite with the ones of a previous
+                run, stored in JSON file f
+
+--gen-db f      Only generates a synthetic DB f of '--items' items (by default
+                1000) using '--days' and '--tags'
+
+-h, --help      Displays this help and exit
+            ''')
+            sys.exit(0)
+        elif o in ("-r", "--repeat"):
+            repeat = int(a)
+        elif o in ("--suite"):
+            mode = 's'
+        elif o in ("--scales"):
+            scales = [int(x) for x in a.split(",")]
+        elif o in ("--days"):
+            n_days = int(a)
+        elif o in ("--tags"):
+            n_tags = int(a)
+        elif o in ("--scenarios"):
+            scenarios = a.split(",")
+            for s in scenarios:
+                if s not in G_BENCH_SCENARIOS:
+                    print("Invalid scenario '" + s + "' specified")
+                    sys.exit(-1)
+        elif o in ("--workers"):
+            wfm.G_FETCH_WORKERS = int(a)
+        elif o in ("--work-dir"):
+            work_dir = a
+        elif o in ("--payloads"):
+            payloads_path = a
+        elif o in ("--out"):
+            out_file = a
+        elif o in ("--compare"):
+            compare_file = a
+        elif o in ("--gen-db"):
+            mode = 'g'
+            gen_file = a
+        elif o in ("--items"):
+            n_items = int(a)
+    if mode == 'p':
+        run_parse(args, repeat)
+    elif mode == 'g':
+        gen_db(gen_file, n_items, n_days, n_tags)
+    elif mode == 's':
+        if wfm.G_FETCH_WORKERS == 1:
+            wfm.G_FETCH_WORKERS = G_BENCH_WORKERS
+        payloads = load_payloads([payloads_path]) if payloads_path else []
+        results = run_suite(scales, scenarios, work_dir, n_days, n_tags, repeat, payloads)
+        if out_file:
+            with open(out_file, 'w') as f:
+                json.dump({'meta': bench_meta({'scales': scales, 'days': n_days, 'tags': n_tags, 'workers': wfm.G_FETCH_WORKERS, 'repeat': repeat, 'payloads': payloads_path}), 'results': results}, f, indent=2)
+        if compare_file:
+            compare_results(results, compare_file)
+
+if __name__ == "__main__":
+    main()